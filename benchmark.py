@@ -0,0 +1,544 @@
+import argparse
+import contextlib
+import csv
+import json
+import math
+import os
+import random
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pymupdf
+
+from main import AwsInvoiceCredit, estimate_tokens, pre_extract
+from read_documents import FOOTER_LINES
+
+# billing countries of the synthetic invoices: country code and name, currency, Amazon company name and branch
+COUNTRIES = [
+    ("US", "United States", "USD", "Amazon Web Services, Inc.", None),
+    ("GB", "United Kingdom", "GBP", "Amazon Web Services EMEA SARL", "UK Branch"),
+    ("DE", "Germany", "EUR", "Amazon Web Services EMEA SARL", "Niederlassung Deutschland"),
+    ("FR", "France", "EUR", "Amazon Web Services EMEA SARL", "Succursale Française"),
+    ("IE", "Ireland", "EUR", "Amazon Web Services EMEA SARL", None),
+    ("AU", "Australia", "AUD", "Amazon Web Services Australia Pty Ltd", None),
+    ("JP", "Japan", "JPY", "Amazon Web Services Japan G.K.", None),
+    ("IN", "India", "INR", "Amazon Web Services India Private Limited", None),
+]
+# USD exchange rates and VAT rates of the currencies
+EXCHANGE_RATES = {"GBP": 0.79095, "EUR": 0.92311, "AUD": 1.51234, "JPY": 151.4025, "INR": 83.3412}
+VAT_RATES = {"GBP": 20.0, "EUR": 21.0, "AUD": 10.0, "JPY": 10.0, "INR": 18.0}
+SERVICES = ["Amazon Elastic Compute Cloud", "Amazon Simple Storage Service", "Amazon Relational Database Service",
+            "AWS Lambda", "Amazon CloudFront", "Amazon DynamoDB", "Elastic Load Balancing", "Amazon CloudWatch",
+            "AWS Data Transfer", "Amazon Elastic Kubernetes Service", "AWS Support (Business)"]
+COMPANIES = ["Texthelp LTD", "Acme Analytics GmbH", "Blue Harbor SAS", "Kangaroo Cloud Pty Ltd", "Sakura Systems KK",
+             "Northwind Traders Inc.", "Globex India Pvt Ltd", "Initech Ltd"]
+PEOPLE = ["Vadim Solovey", "Jane Doe", "John Smith", "Aiko Tanaka", "Priya Sharma", "Lukas Weber", "Claire Martin"]
+# number of text lines on a synthetic PDF page
+LINES_PER_PAGE = 45
+
+
+def format_date(day):
+    return f"{day:%B} {day.day}, {day.year}"
+
+
+# text of a synthetic AWS invoice or credit memo and the values expected to be extracted from it
+def make_invoice(rng, payer_id, index, credit_note=False, ri_invoice=False, line_items=10):
+    country, country_name, currency, amazon_company_name, branch = rng.choice(COUNTRIES)
+    start = date(2024, rng.randint(1, 12), 1)
+    end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    issued = end + timedelta(days=rng.randint(2, 6))
+    prefix = f"EU{'CN' if credit_note else 'IN'}{country}24"
+    invoice_number = f"{prefix}-{rng.randint(10000, 9999999)}"
+    account = "".join(rng.choice("0123456789") for _ in range(12))
+    sign = -1 if credit_note else 1
+
+    charges = [round(rng.uniform(0.5, 2500), 2) for _ in range(line_items)]
+    net_usd = sign * round(sum(charges), 2)
+    rate = EXCHANGE_RATES.get(currency)
+    vat_rate = VAT_RATES.get(currency)
+    vat = round(net_usd * rate * vat_rate / 100, 2) if rate else None
+    total = round(net_usd * (1 + vat_rate / 100), 2) if rate else net_usd
+
+    lines = [amazon_company_name + (f" - {branch}" if branch else ""), "Credit Memo" if credit_note else "Invoice",
+             "Account number:", f"{account[:4]}-{account[4:8]}-{account[8:]}", "Bill to Address:",
+             rng.choice(COMPANIES), f"ATTN: {rng.choice(PEOPLE)}", f"{rng.randint(1, 200)} Main Street",
+             f"Springfield, {rng.randint(10000, 99999)}, {country}", "Invoice Summary"]
+    label = "Credit Memo" if credit_note else "Invoice"
+    lines += [f"{label} Number: {invoice_number}", f"{label} Date: {issued:%B} {issued.day:02d}, {issued.year}"]
+    original_invoice_number = original_invoice_date = None
+    if credit_note:
+        original_invoice_number = f"EUIN{country}24-{rng.randint(10000, 9999999)}"
+        original = issued - timedelta(days=rng.randint(5, 60))
+        original_invoice_date = format_date(original)
+        lines += [f"Original Invoice Number: {original_invoice_number}", f"Original Invoice Date: {original_invoice_date}"]
+    allocation_number = str(rng.randint(100000000, 999999999))
+    lines += [f"Allocation Number: {allocation_number}", f"TOTAL AMOUNT USD {total:.2f}",
+              f"This document is for the billing period {start:%B} {start.day} - {end:%B} {end.day} , {end.year}"]
+    if rate:
+        lines += ["TOTAL VAT", f"{currency} {vat:.2f}", f"1 USD = {rate} {currency}"]
+    lines += ["Summary", f"Net Charges (After Credits/Discounts, excl. Tax) USD {net_usd:.2f}", "Details"]
+    for i, amount in enumerate(charges):
+        fee = " (one time fee)" if ri_invoice and i == 0 else ""
+        lines.append(f"{SERVICES[i % len(SERVICES)]}{fee} USD {sign * amount:.2f}")
+    lines += [FOOTER_LINES[0], "Amazon Web Services terms and conditions apply."]
+
+    file_name = f"{issued:%Y-%m-%d}_{'CreditMemo' if credit_note else 'Invoice'}_{invoice_number.replace('-', '_')}_{index}.pdf"
+    record = {
+        "file_name": file_name, "doit_payer_id": payer_id, "document_type": "Credit Note" if credit_note else "Invoice",
+        "ri_invoice": True if ri_invoice else None, "aws_account_number": account, "address_company": lines[5],
+        "address_attn": lines[6][len("ATTN: "):], "address_country": country_name,
+        "tax_registration_number": None, "invoice_number": invoice_number, "invoice_date": format_date(issued),
+        "allocation_number": allocation_number, "original_invoice_number": original_invoice_number,
+        "original_invoice_date": original_invoice_date, "total_amount": total, "total_amount_currency": "USD",
+        "total_vat_tax_amount": vat, "total_vat_tax_currency": currency if rate else None,
+        "billing_period": f"{format_date(start)} - {format_date(end)}", "net_charges_usd": net_usd,
+        "net_charges_non_usd": round(net_usd * rate, 2) if rate else None,
+        "net_charges_currency": currency if rate else None, "vat_percentage": vat_rate if rate else None,
+        "exchange_rate": rate, "amazon_company_name": amazon_company_name, "amazon_company_branch": branch,
+    }
+    return lines, record
+
+
+# write the text lines to a PDF file, LINES_PER_PAGE lines per page
+def write_pdf(path, lines):
+    doc = pymupdf.open()
+    for start in range(0, len(lines), LINES_PER_PAGE):
+        doc.new_page().insert_text((50, 50), "\n".join(lines[start:start + LINES_PER_PAGE]), fontsize=10)
+    doc.save(path)
+    doc.close()
+
+
+# generate a corpus of synthetic invoices in payer folders (<account>_<payer id>) and the expected values
+# (ground truth for compare_results.py) in <target>/invoices-truth.csv
+def generate_corpus(target, documents=100, payers=10, credit_note_rate=0.2, ri_rate=0.1, max_line_items=120, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(target, exist_ok=True)
+    truth = os.path.join(target, "invoices-truth.csv")
+    with open(truth, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(AwsInvoiceCredit.model_fields))
+        writer.writeheader()
+        for index in range(documents):
+            payer = index % payers
+            payer_id = f"doitintl-payer-{payer}"
+            folder = os.path.join(target, f"{100000000000 + payer}_{payer_id}")
+            os.makedirs(folder, exist_ok=True)
+            lines, record = make_invoice(rng, payer_id, index, credit_note=rng.random() < credit_note_rate,
+                                         ri_invoice=rng.random() < ri_rate, line_items=rng.randint(3, max_line_items))
+            write_pdf(os.path.join(folder, record["file_name"]), lines)
+            writer.writerow(record)
+    print(f"Generated {documents} documents in {target}")
+    return truth
+
+
+# sample response latencies (seconds) from a distribution given as "fixed:S", "uniform:A,B" or "lognormal:MEDIAN,SIGMA"
+def latency_sampler(spec, rng):
+    kind, _, values = spec.partition(":")
+    values = [float(value) for value in values.split(",") if value]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Invalid latency distribution: {spec}")
+
+
+# JSON record the stub returns for a document: the values found by the fast path, required fields not found are empty
+def stub_record(document):
+    record = {name: None if not field.is_required() else 0.0 if field.annotation is float else ""
+              for name, field in AwsInvoiceCredit.model_fields.items()}
+    return {**record, **pre_extract(document)}
+
+
+# content of the chat completion for a rendered extraction prompt (single or packed documents)
+def stub_content(prompt):
+    packed = re.findall(r"<document>\n(.*?)\n</document>", prompt, re.DOTALL)
+    if packed:
+        return json.dumps({"invoices": [stub_record(document) for document in packed]})
+    document = prompt.split("<document>\n", 1)[1].rsplit("\n<document>", 1)[0]
+    return json.dumps(stub_record(document))
+
+
+# local OpenAI compatible chat completions endpoint and Bedrock InvokeModel endpoint (Anthropic messages format)
+# with configurable latency, throttling (HTTP 429) and malformed JSON responses; the peak number of requests in
+# flight shows the concurrency the client actually reached. The OpenAI files and batches endpoints run the requests
+# of a batch without latency (throttled requests go to the error file) and report it in progress for batch_seconds.
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # backlog of connections not accepted yet, bursts of concurrent requests are not refused
+    request_queue_size = 1024
+
+    def __init__(self, address, latency="fixed:0.05", throttle_rate=0.0, malformed_rate=0.0, retry_after=1.0, seed=0,
+                 stall_rate=0.0, stall_seconds=60.0, batch_seconds=0.0):
+        super().__init__(address, StubHandler)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.latency = latency_sampler(latency, self.rng)
+        self.throttle_rate = throttle_rate
+        self.malformed_rate = malformed_rate
+        self.retry_after = retry_after
+        # share of the requests hanging for stall_seconds before they are answered
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.stalled = 0
+        self.batch_seconds = batch_seconds
+        # uploaded and output files by id, batches by id
+        self.files = {}
+        self.batches = {}
+        self.requests = 0
+        self.throttled = 0
+        self.malformed = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    @property
+    def endpoint_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    @property
+    def base_url(self):
+        return f"{self.endpoint_url}/v1"
+
+    # base URL of main.py for the service
+    def url(self, service="openai"):
+        return self.endpoint_url if service == "bedrock" else self.base_url
+
+    @contextlib.contextmanager
+    def request(self):
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    # decide the outcome of a request: latency and whether it is throttled or malformed
+    def draw(self):
+        with self.lock:
+            self.requests += 1
+            throttled = self.rng.random() < self.throttle_rate
+            malformed = not throttled and self.rng.random() < self.malformed_rate
+            self.throttled += throttled
+            self.malformed += malformed
+            stalled = not throttled and self.rng.random() < self.stall_rate
+            self.stalled += stalled
+            return self.latency() + (self.stall_seconds if stalled else 0.0), throttled, malformed
+
+    def summary(self):
+        return (f"Stub requests: {self.requests}, throttled: {self.throttled}, malformed: {self.malformed}, "
+                f"stalled: {self.stalled}, "
+                f"peak in flight: {self.peak_in_flight}")
+
+
+# error of a throttled chat completion request
+RATE_LIMIT_ERROR = {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+
+
+# chat completion response to a request body
+def chat_completion_response(body, malformed=False):
+    prompt = body["messages"][-1]["content"]
+    content = stub_content(prompt)
+    if malformed:
+        content = content[:len(content) // 2]
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop",
+                     "logprobs": None}],
+        "usage": {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": estimate_tokens(content),
+                  "total_tokens": estimate_tokens(prompt) + estimate_tokens(content)},
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.request():
+            if self.path == "/v1/files":
+                return self.create_file(data)
+            body = json.loads(data)
+            if self.path.endswith("/chat/completions"):
+                return self.chat_completion(body)
+            if self.path == "/v1/batches":
+                return self.create_batch(body)
+            model = re.fullmatch(r"/model/([^/]+)/invoke", self.path)
+            if model:
+                return self.invoke_model(body, model.group(1))
+            return self.reply(404, {"error": {"message": f"Unknown endpoint {self.path}"}})
+
+    def do_GET(self):
+        batch = re.fullmatch(r"/v1/batches/([^/]+)", self.path)
+        if batch and batch.group(1) in self.server.batches:
+            return self.reply(200, self.batch_object(self.server.batches[batch.group(1)]))
+        content = re.fullmatch(r"/v1/files/([^/]+)/content", self.path)
+        if content and content.group(1) in self.server.files:
+            return self.reply(200, self.server.files[content.group(1)]["content"], content_type="application/jsonl")
+        return self.reply(404, {"error": {"message": f"Unknown endpoint {self.path}"}})
+
+    def chat_completion(self, body):
+        latency, throttled, malformed = self.server.draw()
+        time.sleep(latency)
+        if throttled:
+            return self.reply(429, RATE_LIMIT_ERROR, {"retry-after": str(self.server.retry_after)})
+        self.reply(200, chat_completion_response(body, malformed))
+
+    # multipart upload of a batch input file
+    def create_file(self, data):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + data)
+        fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+        upload = fields["file"]
+        purpose = fields["purpose"].get_payload(decode=True).decode() if "purpose" in fields else "batch"
+        file = self.store_file(upload.get_payload(decode=True), upload.get_filename() or "upload.jsonl", purpose)
+        self.reply(200, self.file_object(file))
+
+    def store_file(self, content, filename, purpose):
+        file = {"id": f"file-{uuid.uuid4().hex}", "content": content, "filename": filename, "purpose": purpose,
+                "created_at": int(time.time())}
+        with self.server.lock:
+            self.server.files[file["id"]] = file
+        return file
+
+    @staticmethod
+    def file_object(file):
+        return {"id": file["id"], "object": "file", "bytes": len(file["content"]), "created_at": file["created_at"],
+                "filename": file["filename"], "purpose": file["purpose"], "status": "processed"}
+
+    # run the requests of the input file at once, the batch is completed batch_seconds after its creation
+    def create_batch(self, body):
+        if body.get("input_file_id") not in self.server.files:
+            return self.reply(404, {"error": {"message": f"No such file: {body.get('input_file_id')}"}})
+        outputs, errors = [], []
+        for line in self.server.files[body["input_file_id"]]["content"].decode().splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            _, throttled, malformed = self.server.draw()
+            result = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"]}
+            if throttled:
+                errors.append({**result, "response": {"status_code": 429, "request_id": uuid.uuid4().hex,
+                                                      "body": RATE_LIMIT_ERROR}, "error": None})
+            else:
+                outputs.append({**result, "response": {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                                       "body": chat_completion_response(request["body"], malformed)},
+                                "error": None})
+        batch = {"id": f"batch_{uuid.uuid4().hex}", "input_file_id": body["input_file_id"],
+                 "endpoint": body.get("endpoint", "/v1/chat/completions"),
+                 "completion_window": body.get("completion_window", "24h"), "created_at": time.time(),
+                 "request_counts": {"total": len(outputs) + len(errors), "completed": len(outputs),
+                                    "failed": len(errors)}}
+        for name, results in (("output_file_id", outputs), ("error_file_id", errors)):
+            content = "".join(json.dumps(result) + "\n" for result in results).encode()
+            batch[name] = self.store_file(content, f"{batch['id']}_{name[:-8]}.jsonl", "batch_output")["id"] \
+                if results else None
+        with self.server.lock:
+            self.server.batches[batch["id"]] = batch
+        self.reply(200, self.batch_object(batch))
+
+    def batch_object(self, batch):
+        completed = time.time() >= batch["created_at"] + self.server.batch_seconds
+        return {"id": batch["id"], "object": "batch", "endpoint": batch["endpoint"],
+                "input_file_id": batch["input_file_id"], "completion_window": batch["completion_window"],
+                "created_at": int(batch["created_at"]), "status": "completed" if completed else "in_progress",
+                "output_file_id": batch["output_file_id"] if completed else None,
+                "error_file_id": batch["error_file_id"] if completed else None,
+                "request_counts": batch["request_counts"] if completed else {
+                    "total": batch["request_counts"]["total"], "completed": 0, "failed": 0}}
+
+    # Bedrock InvokeModel with the Anthropic messages body used by BedrockChat
+    def invoke_model(self, body, model_id):
+        latency, throttled, malformed = self.server.draw()
+        time.sleep(latency)
+        if throttled:
+            return self.reply(429, {"message": "Too many requests, please wait before trying again."},
+                              {"x-amzn-ErrorType": "ThrottlingException"})
+        prompt = body["messages"][-1]["content"]
+        if isinstance(prompt, list):
+            prompt = "".join(block.get("text", "") for block in prompt)
+        content = stub_content(prompt)
+        if malformed:
+            content = content[:len(content) // 2]
+        prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(content)
+        self.reply(200, {
+            "id": f"msg_{uuid.uuid4().hex}", "type": "message", "role": "assistant", "model": model_id,
+            "content": [{"type": "text", "text": content}], "stop_reason": "end_turn",
+            "usage": {"input_tokens": prompt_tokens, "output_tokens": completion_tokens},
+        }, {"x-amzn-bedrock-input-token-count": str(prompt_tokens),
+            "x-amzn-bedrock-output-token-count": str(completion_tokens)})
+
+    def reply(self, status, payload, headers=None, content_type="application/json"):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # keep the benchmark output readable
+    def log_message(self, format, *args):
+        pass
+
+
+# start the stub server in a background thread
+def start_stub(host="127.0.0.1", port=0, **options):
+    server = StubServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Bedrock model id of the benchmark runs (the provider prefix selects the Anthropic messages format)
+BEDROCK_MODEL = "anthropic.claude-3-haiku-20240307-v1:0"
+
+
+# run main.py as a subprocess against the base URL and measure documents/sec, time to first record and peak RSS
+def run_main(data_dir, output, base_url, concurrency, main_args=(), service="openai"):
+    data_dir, output = os.path.abspath(data_dir), os.path.abspath(output)
+    for path in (output, f"{output}.journal"):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    command = [sys.executable, "main.py", f"--data_dir={data_dir}", f"--output={output}", f"--base_url={base_url}",
+               f"--concurrency={concurrency}"]
+    if service == "bedrock":
+        command += ["--service=bedrock", f"--model={BEDROCK_MODEL}"]
+    command += main_args
+    env = dict(os.environ, OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "benchmark"), NO_PROXY="127.0.0.1,localhost",
+               PYTHONUNBUFFERED="1")
+    if service == "bedrock":
+        # the stub does not check the request signature, but botocore needs credentials and a region to sign
+        env.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+        env.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+        env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    start = time.monotonic()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    records, failed, first_record = 0, 0, None
+    for line in process.stdout:
+        if line.startswith("Added record for:"):
+            records += 1
+            if first_record is None:
+                first_record = time.monotonic() - start
+        elif line.startswith("Error processing document"):
+            failed += 1
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.monotonic() - start
+    if status != 0:
+        raise RuntimeError(f"main.py exited with status {status}: {shlex.join(command)}")
+    return {"concurrency": concurrency, "records": records, "failed": failed, "seconds": round(elapsed, 3),
+            "docs_per_sec": round((records + failed) / elapsed, 2), "first_record": round(first_record or 0.0, 3),
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": round(usage.ru_maxrss / 1024, 1)}
+
+
+# run the benchmark for each concurrency level and print (and optionally append to a CSV file) the results
+def run_benchmark(data_dir, concurrency_levels, output="benchmark-output.csv", base_url=None, main_args=(),
+                  results=None, service="openai", **stub_options):
+    server = None
+    if base_url is None:
+        server = start_stub(**stub_options)
+        base_url = server.url(service)
+    rows = []
+    for concurrency in concurrency_levels:
+        if server is not None:
+            server.peak_in_flight = 0
+        row = run_main(data_dir, output, base_url, concurrency, main_args, service)
+        if server is not None:
+            row["peak_in_flight"] = server.peak_in_flight
+        rows.append(row)
+        print(", ".join(f"{key}: {value}" for key, value in row.items()))
+    if server is not None:
+        print(server.summary())
+        server.shutdown()
+    if results:
+        new_file = not os.path.exists(results)
+        with open(results, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["time", "main_args", *rows[0]])
+            if new_file:
+                writer.writeheader()
+            for row in rows:
+                writer.writerow({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "main_args": shlex.join(main_args), **row})
+    return rows
+
+
+def add_stub_arguments(parser):
+    parser.add_argument("--latency", default="fixed:0.05",
+                        help="response latency distribution: fixed:S, uniform:A,B or lognormal:MEDIAN,SIGMA (seconds)")
+    parser.add_argument("--throttle_rate", type=float, default=0.0, help="share of requests rejected with HTTP 429")
+    parser.add_argument("--malformed_rate", type=float, default=0.0, help="share of responses with truncated JSON")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After of throttled requests (seconds)")
+    parser.add_argument("--stall_rate", type=float, default=0.0, help="share of requests hanging before the response")
+    parser.add_argument("--stall_seconds", type=float, default=60.0, help="duration of the stalled requests (seconds)")
+    parser.add_argument("--batch_seconds", type=float, default=0.0,
+                        help="duration of the batches before they are completed (seconds)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the extraction pipeline with synthetic invoices "
+                                                 "and a local OpenAI compatible stub server.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="generate a synthetic invoice corpus")
+    generate.add_argument("--target", default="data/benchmark", help="folder for the generated documents")
+    generate.add_argument("--documents", type=int, default=100, help="number of documents")
+    generate.add_argument("--payers", type=int, default=10, help="number of payer folders")
+    generate.add_argument("--credit_note_rate", type=float, default=0.2, help="share of credit notes")
+    generate.add_argument("--ri_rate", type=float, default=0.1, help="share of Reserved Instance invoices")
+    generate.add_argument("--max_line_items", type=int, default=120,
+                          help=f"maximum number of line items ({LINES_PER_PAGE} lines per page)")
+    generate.add_argument("--seed", type=int, default=0, help="random seed")
+
+    serve = commands.add_parser("serve", help="run the stub server")
+    serve.add_argument("--port", type=int, default=8000, help="port of the stub server")
+    add_stub_arguments(serve)
+
+    run = commands.add_parser("run", help="run main.py against the stub server for each concurrency level")
+    run.add_argument("--data_dir", default="data/benchmark", help="folder with the documents")
+    run.add_argument("--concurrency", type=int, nargs="+", default=[10, 50], help="concurrency levels")
+    run.add_argument("--output", default="benchmark-output.csv",
+                     help="output file (or Parquet dataset) of main.py, removed before each run")
+    run.add_argument("--base_url", help="use an already running server instead of starting the stub")
+    run.add_argument("--service", choices=["openai", "bedrock"], default="openai",
+                     help=f"service of main.py: the stub serves both the OpenAI and the Bedrock API ({BEDROCK_MODEL})")
+    run.add_argument("--main_args", default="", help='additional arguments of main.py, e.g. "--stream --parse_workers=4"')
+    run.add_argument("--results", help="CSV file the results are appended to")
+    add_stub_arguments(run)
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate_corpus(args.target, args.documents, args.payers, args.credit_note_rate, args.ri_rate,
+                        args.max_line_items, args.seed)
+        return
+    stub_options = {"latency": args.latency, "throttle_rate": args.throttle_rate,
+                    "malformed_rate": args.malformed_rate, "retry_after": args.retry_after, "seed": args.seed,
+                    "stall_rate": args.stall_rate, "stall_seconds": args.stall_seconds,
+                    "batch_seconds": args.batch_seconds}
+    if args.command == "serve":
+        server = StubServer(("127.0.0.1", args.port), **stub_options)
+        print(f"Serving on {server.base_url} (OpenAI) and {server.endpoint_url} (Bedrock)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print(server.summary())
+        return
+    run_benchmark(args.data_dir, args.concurrency, args.output, args.base_url, shlex.split(args.main_args),
+                  args.results, args.service, **stub_options)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,9 @@ import argparse
 import pandas as pd
 import os
 
+# absolute tolerance for floating-point comparisons
+FLOAT_TOLERANCE = 0.0001
+
 
 def compare_values(val1, val2):
     # Check for NaN equality or one is NaN and the other is 0 or 0.0
@@ -14,95 +17,171 @@ def compare_values(val1, val2):
         return val1.strip().lower() == val2.strip().lower()
     # Handle floating-point numbers with a tolerance
     elif isinstance(val1, float) and isinstance(val2, float):
-        return abs(val1 - val2) < 0.0001
+        return abs(val1 - val2) < FLOAT_TOLERANCE
     # Direct comparison for other types
     else:
         return val1 == val2
 
 
+# compare two aligned columns element-wise with the same rules as compare_values
+def compare_columns(test, experiment):
+    test_na, experiment_na = test.isna(), experiment.isna()
+    # NaN equality or one is NaN and the other is 0 or 0.0
+    equal = (test_na & experiment_na) | (test_na & experiment.isin([0])) | (experiment_na & test.isin([0]))
+    both = ~test_na & ~experiment_na
+    # string-specific comparisons (trim and case-insensitive)
+    strings = both & test.map(lambda value: isinstance(value, str)) & experiment.map(lambda value: isinstance(value, str))
+    if strings.any():
+        equal |= strings & (test[strings].str.strip().str.lower() == experiment[strings].str.strip().str.lower()).reindex(
+            test.index, fill_value=False)
+    # floating-point numbers with a tolerance
+    floats = both & test.map(lambda value: isinstance(value, float)) & experiment.map(lambda value: isinstance(value, float))
+    if floats.any():
+        difference = (test[floats].astype(float) - experiment[floats].astype(float)).abs()
+        equal |= floats & (difference < FLOAT_TOLERANCE).reindex(test.index, fill_value=False)
+    # direct comparison for other types
+    others = both & ~strings & ~floats
+    if others.any():
+        equal |= others & (test[others] == experiment[others]).reindex(test.index, fill_value=False)
+    return equal
+
+
+# name of the model from the CSV file name, without the prefix and the extension
+def model_name(path, prefix):
+    name = os.path.basename(path)
+    name = name.replace(prefix, '')
+    return name.replace('.csv', '').replace('.parquet', '')
+
+
+# compare an experiment with the test data joined on the "file_name" column; returns the report and the
+# differing rows (test row followed by the experiment row) for the differences file
+def compare_frames(test, experiment, test_name, experiment_name, skip_columns_list):
+    # Identify common columns between the two DataFrames, in the original column order of the test data
+    common_columns = [col for col in test.columns if col in experiment.columns]
+    compared_columns = [col for col in common_columns if col != "file_name" and col not in skip_columns_list]
+
+    # nullable integers keep integer columns (e.g. account numbers) from turning into floats in the outer join
+    test, experiment = (frame[common_columns].astype({col: "Int64" for col in common_columns
+                                                      if pd.api.types.is_integer_dtype(frame[col])})
+                        for frame in (test, experiment))
+    joined = test.merge(experiment, on="file_name", how="outer",
+                                        suffixes=("_test", "_experiment"), indicator=True)
+    missing = joined.loc[joined["_merge"] == "left_only", "file_name"].tolist()
+    extra = joined.loc[joined["_merge"] == "right_only", "file_name"].tolist()
+    matched = joined[joined["_merge"] == "both"].reset_index(drop=True)
+
+    equal = pd.DataFrame({col: compare_columns(matched[f"{col}_test"], matched[f"{col}_experiment"])
+                          for col in compared_columns}, index=matched.index)
+    rows_equal = equal.all(axis=1)
+    accuracy = pd.DataFrame({"accuracy": equal.mean(), "differences": (~equal).sum()}) if len(matched) else \
+        pd.DataFrame(columns=["accuracy", "differences"])
+
+    confusion = None
+    if "document_type" in common_columns:
+        # labels are normalized like compare_values compares strings
+        confusion = pd.crosstab(matched["document_type_test"].astype(str).str.strip().str.lower(),
+                                matched["document_type_experiment"].astype(str).str.strip().str.lower(),
+                                rownames=["test"], colnames=["experiment"])
+
+    # test and experiment rows of the documents with differences
+    different = matched[~rows_equal]
+    test_rows = different[["file_name"] + [f"{col}_test" for col in common_columns if col != "file_name"]]
+    test_rows.columns = common_columns
+    experiment_rows = different[["file_name"] + [f"{col}_experiment" for col in common_columns if col != "file_name"]]
+    experiment_rows.columns = common_columns
+    test_rows = test_rows.assign(model_name=test_name, _order=range(0, 2 * len(different), 2))
+    experiment_rows = experiment_rows.assign(model_name=experiment_name, _order=range(1, 2 * len(different), 2))
+    differences = pd.concat([test_rows, experiment_rows]).sort_values("_order").drop(columns="_order")
+
+    report = {
+        "similar_rows": int(rows_equal.sum()),
+        "different_rows": int((~rows_equal).sum()),
+        "missing": missing,
+        "extra": extra,
+        "accuracy": accuracy,
+        "confusion": confusion,
+    }
+    return report, differences
+
+
+def print_report(experiment_name, report):
+    print(f"Experiment: {experiment_name}")
+    print(f"Similar rows: {report['similar_rows']}, Different rows: {report['different_rows']}")
+    print(f"Missing documents: {len(report['missing'])}, Extra documents: {len(report['extra'])}")
+    for label in ("missing", "extra"):
+        for file_name in report[label]:
+            print(f"  {label}: {file_name}")
+    print("Per-column accuracy:")
+    print(report["accuracy"].to_string(float_format=lambda value: f"{value:.2%}"))
+    if report["confusion"] is not None:
+        print("Document type confusion:")
+        print(report["confusion"].to_string())
+
+
+def is_parquet(path):
+    return os.path.isdir(path) or path.endswith(".parquet")
+
+
+# read a results CSV file (with the given columns as strings) or Parquet dataset (file or directory)
+def read_results(path, string_columns=()):
+    if is_parquet(path):
+        frame = pd.read_parquet(path)
+    else:
+        frame = pd.read_csv(path, dtype={col: str for col in string_columns})
+    # Check if "file_name" column exists
+    if "file_name" not in frame.columns:
+        raise ValueError("The 'file_name' column must be present in both result files.")
+    duplicates = frame["file_name"].duplicated()
+    if duplicates.any():
+        print(f"Ignoring {duplicates.sum()} duplicated file names in {path}")
+        frame = frame[~duplicates]
+    return frame
+
+
+# compare one or more experiment results (CSV files or Parquet datasets) with the test results and write the
+# differences to output_path
 def compare_csv_files(test_path, experiment_path, output_path=None, prefix="invoices-", skip_columns_list=None):
-    # Load CSV files into DataFrames
     if skip_columns_list is None:
         skip_columns_list = []
-    test = pd.read_csv(test_path)
-    experiment = pd.read_csv(experiment_path)
-
+    experiment_paths = [experiment_path] if isinstance(experiment_path, str) else list(experiment_path)
+    # Load Parquet datasets first: their string columns (e.g. account numbers with leading zeros) are read as strings
+    # from the CSV files too, instead of being inferred as numbers
+    parquet = {path: read_results(path) for path in [test_path, *experiment_paths] if is_parquet(path)}
+    string_columns = {col for frame in parquet.values() for col in frame.columns
+                      if pd.api.types.infer_dtype(frame[col], skipna=True) == "string"}
+    test = parquet.get(test_path)
+    if test is None:
+        test = read_results(test_path, string_columns)
     # Record the original column order from the test DataFrame
     original_column_order = test.columns.tolist()
 
-    # Identify common columns between the two DataFrames
-    common_columns = list(set(test.columns).intersection(set(experiment.columns)))
-    test = test[common_columns]
-    experiment = experiment[common_columns]
-
-    # Check if "file_name" column exists in both DataFrames
-    if "file_name" not in test.columns or "file_name" not in experiment.columns:
-        raise ValueError("The 'file_name' column must be present in both CSV files.")
-
-    # Sort both DataFrames by the "file_name" column
-    test = test.sort_values(by="file_name").reset_index(drop=True)
-    experiment = experiment.sort_values(by="file_name").reset_index(drop=True)
-
-    similar_rows = 0
-    different_rows = 0
-    differences = []  # This will store pandas Series directly
-
-    # Compare rows between test and experiment DataFrames
-    for i in range(len(test)):
-        row_equal = True
-        for col in test.columns:
-            # Skip comparison for columns in skip_columns_list
-            if col in skip_columns_list:
-                continue
-
-            test_value = test.iloc[i][col]
-            experiment_value = experiment.iloc[i][col]
-
-            if not compare_values(test_value, experiment_value):
-                row_equal = False
-                # Debugging aid: Uncomment the following line to see which values are different
-                # print(f"Difference in row {i}, column {col}: {test_value} vs {experiment_value}")
-                break
-
-        if not row_equal:
-            different_rows += 1
-            # Create a copy of the row from 'test' and add a new column
-            test_row = test.iloc[i].copy()
-            # extract the file name from the path and add it as a new column without the prefix and .csv
-            name = os.path.basename(test_path)
-            name = name.replace(prefix, '')
-            name = name.replace('.csv', '')
-            test_row = pd.concat([pd.Series([name], index=['model_name']), test_row])
-            # Create a copy of the row from 'experiment' and add a new column
-            experiment_row = experiment.iloc[i].copy()
-            # extract the file name from the path and add it as a new column without the prefix and .csv
-            name = os.path.basename(experiment_path)
-            name = name.replace(prefix, '')
-            name = name.replace('.csv', '')
-            experiment_row = pd.concat([pd.Series([name], index=['model_name']), experiment_row])
-
-            # Append differing rows as Series directly
-            differences.append(test_row)
-            differences.append(experiment_row)
-        else:
-            similar_rows += 1
-
-    print(f"Similar rows: {similar_rows}, Different rows: {different_rows}")
+    reports = {}
+    differences = []
+    for path in experiment_paths:
+        experiment = parquet[path] if path in parquet else read_results(path, string_columns)
+        name = model_name(path, prefix)
+        report, different_rows = compare_frames(test, experiment, model_name(test_path, prefix), name, skip_columns_list)
+        print_report(name, report)
+        reports[path] = report
+        differences.append(different_rows)
 
     # If there are differences and an output path is provided, write them to a CSV file
-    if differences and output_path:
-        differences_df = pd.DataFrame(differences)
+    differences_df = pd.concat(differences) if differences else pd.DataFrame()
+    if len(differences_df) and output_path:
         updated_column_order = ['model_name'] + [col for col in original_column_order if col in differences_df.columns]
         differences_df = differences_df[updated_column_order]
         differences_df.to_csv(output_path, index=False)
+    return reports
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Compare two CSV files and optionally output differences to a new file.")
-    parser.add_argument("--test_path", type=str, help="Path to the test data CSV file")
-    parser.add_argument("--experiment_path", type=str, help="Path to the experiment data CSV file")
+    parser = argparse.ArgumentParser(description="Compare experiment CSV files with the test CSV file and optionally output differences to a new file.")
+    parser.add_argument("--test_path", type=str, help="Path to the test data CSV file or Parquet dataset")
+    parser.add_argument("--experiment_path", type=str, nargs="+",
+                        help="Path to one or more experiment data CSV files or Parquet datasets")
     parser.add_argument("--output_path", type=str, help="Path to the output CSV file for differences", required=False)  # Ensure this matches the function parameter
-    parser.add_argument("--prefix", type=str, help="Prefix to remove from the file name in the output file", required=False)
+    parser.add_argument("--prefix", type=str, help="Prefix to remove from the file name in the output file", default="invoices-",
+                        required=False)
     parser.add_argument("--skip_columns", type=str, help="Comma-separated list of columns to skip from comparison",
                         default="")
     args = parser.parse_args()
@@ -1,18 +1,39 @@
 import asyncio
 import argparse
+import collections
+import contextlib
+import contextvars
 import csv
+import ctypes
+import fnmatch
+import functools
+import hashlib
+import httpx
+import itertools
 import json
+import math
+import openai
 import os
+import random
+import re
+import select
+import shutil
+import signal
+import sqlite3
+import struct
 import textwrap
+import threading
 import time
-from langchain_community.document_loaders import PyMuPDFLoader
+import uuid
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from langchain.output_parsers import PydanticOutputParser
-from langchain.prompts import PromptTemplate
-from langchain_core.runnables import RunnablePassthrough
 from langchain_openai import ChatOpenAI
 from langchain_community.chat_models import BedrockChat
-from pydantic import BaseModel, Field
-from typing import Optional
+from pydantic import BaseModel, Field, create_model
+from typing import List, Optional, Union, get_args, get_origin
+
+from read_documents import parallel_map, read_document
 
 
 # Define a new Pydantic model with field descriptions and tailored for AWS Invoice/Credit Record.
@@ -64,45 +85,470 @@ class AwsInvoiceCredit(BaseModel):
                                                  description="The specific branch of Amazon Web Services, if mentioned, excluding full company name and address details. Typically after the 'Amazon Web Services EMEA SARL' but can be different for different countries.")
 
 
-# remove everything after one of the following lines (including the line itself)
-def remove_footer(text):
-    # remove everything after one of the following lines (including the line itself)
-    lines = [
-        "* May include estimated US sales tax, VAT, ST, GST and CT.",
-    ]
-    for line in lines:
-        if line in text:
-            return text.split(line)[0]
-    return text
+# default rules of the preprocessing of the invoice text (regular expressions matched against whole lines, after
+# whitespace normalisation); a JSON rules file replaces the rules it defines
+PREPROCESS_RULES = {
+    # boilerplate lines removed everywhere
+    "remove": [
+        r"^Page \d+ of \d+$",
+        r"^Amazon Web Services terms and conditions apply\.?$",
+        r"^(Please|Kindly) (note|refer|see|contact)\b.*",
+        r"^(For|If you have) (any )?(questions|information|details)\b.*",
+        r"^https?://\S+$",
+    ],
+    # page headers kept only the first time they occur
+    "repeated": [
+        r"(?i)^Amazon (Web Services|AWS Servi\w+|Internet Services)\b.*",
+        r"^Account (number|Number|#):?",
+        r"^\d{4}-?\d{4}-?\d{4}$",
+        r"^(Invoice|Credit Memo|Credit Note|Credit Adjustment Note|Tax Invoice Adjustment) (Number|Date):?",
+        r"^(Invoice|Credit Memo|Credit Note|Credit Adjustment Note|Tax Invoice Adjustment)$",
+    ],
+    # first line of the per-service line items (until the end of the document or a line matching line_items_end)
+    "line_items_start": r"^(Details?|Detail for .*|Charges by (service|Service).*|Service Charges)$",
+    "line_items_end": r"^(Invoice Summary|Summary)$",
+    # line items kept when the line item sections are collapsed; a kept line without an amount keeps the next line
+    "keep": [
+        r"\(one time fee\)",
+        r"\bTOTAL\b",
+        r"\b(VAT|GST|HST|Tax|TAX)\b",
+        r"\b1 USD = ",
+        r"\b[Ee]xchange [Rr]ate\b",
+        r"\bNet Charges\b",
+    ],
+}
 
 
-# scan all documents in the folder (recursively)
-def scan_folder(folder, max_docs=0, processed_files=None):
-    if processed_files is None:
-        processed_files = []
-    documents = []
-    doc_count = 0
+# load a JSON preprocessing rules file
+def load_preprocess_rules(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# shrink the invoice text sent to the LLM: normalise whitespace, remove boilerplate lines and repeated page headers
+# and collapse the line item sections to the lines the extracted fields depend on (RI markers, totals, VAT and
+# exchange rates); the header lines with the file name and the payer id are always kept
+class Preprocessor:
+    def __init__(self, rules=None):
+        rules = {**PREPROCESS_RULES, **(rules or {})}
+        self.remove = [re.compile(pattern) for pattern in rules["remove"]]
+        self.repeated = [re.compile(pattern) for pattern in rules["repeated"]]
+        self.line_items_start = re.compile(rules["line_items_start"]) if rules["line_items_start"] else None
+        self.line_items_end = re.compile(rules["line_items_end"]) if rules["line_items_end"] else None
+        self.keep = [re.compile(pattern) for pattern in rules["keep"]]
+        self.documents = 0
+        self.raw_tokens = 0
+        self.tokens = 0
+        self.removed_lines = 0
+        self.collapsed_lines = 0
+
+    # preprocessed document and the estimated number of tokens before and after
+    def process(self, document):
+        lines = [" ".join(line.split()) for line in document.split("\n")]
+        result = lines[:2]
+        seen = set()
+        line_items = False
+        omitted = 0
+        keep_next = False
+        for line in lines[2:]:
+            if not line or any(pattern.search(line) for pattern in self.remove):
+                self.removed_lines += bool(line)
+                continue
+            if any(pattern.search(line) for pattern in self.repeated):
+                if line in seen:
+                    self.removed_lines += 1
+                    continue
+                seen.add(line)
+            if line_items and self.line_items_end and self.line_items_end.search(line):
+                line_items = False
+            if line_items and not keep_next and not any(pattern.search(line) for pattern in self.keep):
+                omitted += 1
+                continue
+            if omitted:
+                result.append(f"[{omitted} line items omitted]")
+                self.collapsed_lines += omitted
+                omitted = 0
+            result.append(line)
+            # the amount of a kept label is often on the next line (e.g. TOTAL VAT)
+            keep_next = line_items and not keep_next and not any(char.isdigit() for char in line)
+            if not line_items and self.line_items_start and self.line_items_start.search(line):
+                line_items = True
+        if omitted:
+            result.append(f"[{omitted} line items omitted]")
+            self.collapsed_lines += omitted
+        text = "\n".join(result) + "\n"
+        raw_tokens, tokens = estimate_tokens(document), estimate_tokens(text)
+        self.documents += 1
+        self.raw_tokens += raw_tokens
+        self.tokens += tokens
+        return text, raw_tokens, tokens
+
+    def summary(self):
+        raw_tokens = self.raw_tokens / self.documents if self.documents else 0.0
+        tokens = self.tokens / self.documents if self.documents else 0.0
+        reduction = 1 - tokens / raw_tokens if raw_tokens else 0.0
+        return (f"Preprocessing: {raw_tokens:.0f} -> {tokens:.0f} text tokens/document ({reduction:.0%} fewer), "
+                f"boilerplate lines removed: {self.removed_lines}, line items collapsed: {self.collapsed_lines}")
+
+
+# preprocess a parsed document (if enabled, reporting its tokens before and after) and start its span (if telemetry
+# is provided); returns the document
+def prepare_document(path, invoice, parse_time, preprocessor=None, telemetry=None):
+    raw_tokens = tokens = None
+    if preprocessor is not None:
+        invoice, raw_tokens, tokens = preprocessor.process(invoice)
+        print(f"Preprocessed {path}: {raw_tokens} -> {tokens} text tokens")
+    if telemetry is not None:
+        telemetry.parsed(path, parse_time, raw_tokens, tokens)
+    return invoice
+
+
+# list all PDF files in the folder (recursively), except those for which skip(path) is true
+def iter_pdf_files(folder, skip=None):
     for root, dirs, files in os.walk(folder):
         for file in files:
-            if file.endswith(".pdf") and file not in processed_files:
-                loader = PyMuPDFLoader(os.path.join(str(root), str(file)))
-                data = loader.load()
-                invoice = remove_footer(data[0].page_content)
-                # get parent folder name
-                parent_folder = os.path.basename(os.path.dirname(os.path.join(root, file)))
-                # extract doit payer id from the parent folder name
-                payer_id = parent_folder.split("_")[1]
-                # add file name to the invoice
-                invoice = f"File name: {file}\nDoiT payer id: {payer_id}\n" + invoice
-                documents.append(invoice)
-                doc_count += 1
-                # log progress every 100 documents
-                if doc_count % 100 == 0:
-                    print(f"Parsed {doc_count} documents")
-                # break if max_docs is reached
-                if max_docs != 0 and doc_count >= max_docs:
-                    return documents
-    return documents
+            path = os.path.join(str(root), str(file))
+            if file.endswith(".pdf") and not (skip and skip(path)):
+                yield path
+
+
+# scan all documents in the folder (recursively) and yield (path, document) pairs one by one as they are parsed
+# (and preprocessed, if a preprocessor is provided); the parse time of each document is reported to the telemetry,
+# if provided
+def iter_documents(folder, max_docs=0, skip=None, parse_workers=1, max_pages=1, telemetry=None, preprocessor=None):
+    paths = iter_pdf_files(folder, skip)
+    # stop if max_docs is reached
+    if max_docs != 0:
+        paths = itertools.islice(paths, max_docs)
+    read = functools.partial(read_document, max_pages=max_pages)
+    if parse_workers > 1:
+        documents = parallel_map(read, paths, parse_workers)
+    else:
+        documents = map(read, paths)
+    for doc_count, (path, invoice, parse_time) in enumerate(documents, start=1):
+        # log progress every 100 documents
+        if doc_count % 100 == 0:
+            print(f"Parsed {doc_count} documents")
+        yield path, prepare_document(path, invoice, parse_time, preprocessor, telemetry)
+
+
+# scan all documents in the folder (recursively) and yield them one by one as they are parsed
+def iter_folder(folder, max_docs=0, processed_files=None, parse_workers=1, max_pages=1):
+    processed_files = set(processed_files or [])
+    for _, invoice in iter_documents(folder, max_docs, lambda path: os.path.basename(path) in processed_files,
+                                     parse_workers, max_pages):
+        yield invoice
+
+
+# scan all documents in the folder (recursively)
+def scan_folder(folder, max_docs=0, processed_files=None, parse_workers=1, max_pages=1):
+    return list(iter_folder(folder, max_docs, processed_files, parse_workers, max_pages))
+
+
+# inotify event masks (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+# watch a folder (recursively) for new or rewritten PDF files: inotify on Linux, otherwise polling the modification
+# time of the known folders (only changed folders are listed, never the whole tree, so polling sees files replaced
+# or created again but not files rewritten in place)
+class FolderWatcher:
+    def __init__(self, folder, poll_interval=2.0, use_inotify=True):
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self.fd = None
+        # inotify watch descriptor -> folder
+        self.watches = {}
+        # polling: folder -> modification time and signatures of its PDF files by name, new or changed files ->
+        # signature at the last poll
+        self.folders = {}
+        self.pending = {}
+        if use_inotify:
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                self.add_watch = libc.inotify_add_watch
+                self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+                if self.fd < 0:
+                    raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            except (AttributeError, OSError) as e:
+                print(f"inotify is not available, polling {folder} every {poll_interval} seconds: {e}")
+                self.fd = None
+
+    # watch the folder and its subfolders and return the PDF files already in them (the only walk of the tree)
+    def start(self):
+        return list(self.add_tree(self.folder))
+
+    def add_tree(self, folder):
+        for root, dirs, files in os.walk(folder):
+            if self.fd is not None:
+                wd = self.add_watch(self.fd, os.fsencode(root), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+                if wd < 0:
+                    print(f"Unable to watch {root}: {os.strerror(ctypes.get_errno())}")
+                else:
+                    self.watches[wd] = root
+            else:
+                self.folders[root] = (os.stat(root).st_mtime_ns, self.signatures(root, files))
+            for file in files:
+                if file.endswith(".pdf"):
+                    yield os.path.join(root, file)
+
+    # yield the paths of new PDF files until stop (a threading.Event) is set
+    def watch(self, stop):
+        while not stop.is_set():
+            yield from self.inotify_events() if self.fd is not None else self.poll()
+            if self.fd is None:
+                stop.wait(self.poll_interval)
+
+    def inotify_events(self):
+        readable, _, _ = select.select([self.fd], [], [], 1.0)
+        if not readable:
+            return
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0")
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                print(f"Missed inotify events, scanning {self.folder} again")
+                yield from self.add_tree(self.folder)
+            elif wd in self.watches:
+                path = os.path.join(self.watches[wd], os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    # files can be written to a new folder before it is watched
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        yield from self.add_tree(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and path.endswith(".pdf"):
+                    yield path
+
+    # size and modification time of the PDF files of a folder, by name
+    @staticmethod
+    def signatures(folder, names):
+        signatures = {}
+        for name in names:
+            if name.endswith(".pdf"):
+                with contextlib.suppress(FileNotFoundError):
+                    signatures[name] = file_signature(os.path.join(folder, name))
+        return signatures
+
+    # list the folders whose modification time changed; new or changed files are yielded once their size and
+    # modification time did not change between two polls (they are completely written)
+    def poll(self):
+        for folder, (mtime, signatures) in list(self.folders.items()):
+            try:
+                current = os.stat(folder).st_mtime_ns
+            except FileNotFoundError:
+                del self.folders[folder]
+                continue
+            if current == mtime:
+                continue
+            with os.scandir(folder) as entries:
+                entries = list(entries)
+            current_signatures = self.signatures(folder, [entry.name for entry in entries if entry.is_file()])
+            self.folders[folder] = (current, current_signatures)
+            for entry in entries:
+                if entry.is_dir() and entry.path not in self.folders:
+                    for path in self.add_tree(entry.path):
+                        self.pending[path] = None
+                elif entry.name in current_signatures and current_signatures[entry.name] != signatures.get(entry.name):
+                    self.pending[entry.path] = None
+        for path, signature in list(self.pending.items()):
+            try:
+                current = file_signature(path)
+            except FileNotFoundError:
+                del self.pending[path]
+                continue
+            if current == signature:
+                del self.pending[path]
+                yield path
+            else:
+                self.pending[path] = current
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# parse the PDF files already in the folder, then the new ones as they arrive, until stop is set; the same file is
+# parsed again only if it was rewritten (documents that fail to parse are reported and skipped)
+def watch_documents(watcher, stop, max_docs=0, skip=None, max_pages=1, telemetry=None, preprocessor=None):
+    parsed = {}
+    paths = itertools.chain(watcher.start(), watcher.watch(stop))
+    documents = 0
+    for path in paths:
+        # the documents already in the folder are not extracted either once stopped
+        if stop.is_set():
+            return
+        try:
+            signature = file_signature(path)
+        except FileNotFoundError:
+            continue
+        if parsed.get(path) == signature or (skip and skip(path)):
+            continue
+        parsed[path] = signature
+        try:
+            path, invoice, parse_time = read_document(path, max_pages)
+        except Exception as e:
+            print(f"Error parsing document {path}: {e}")
+            continue
+        yield path, prepare_document(path, invoice, parse_time, preprocessor, telemetry)
+        documents += 1
+        if documents == max_docs:
+            return
+
+
+# size and modification time of a file, to detect changes without reading it
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+# hash of the file content
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# path relative to the data folder with forward slashes, the stable identifier of a document across machines
+def relative_path(path, root):
+    return os.path.relpath(path, root).replace(os.sep, "/")
+
+
+# shard (1 to shards) of a document by a stable hash of its relative path
+def shard_of(relative_path, shards):
+    return int.from_bytes(hashlib.sha256(relative_path.encode()).digest()[:8], "big") % shards + 1
+
+
+# parse a "K/N" shard specification
+def parse_shard(spec):
+    shard, _, shards = spec.partition("/")
+    shard, shards = int(shard), int(shards)
+    if not 1 <= shard <= shards:
+        raise ValueError(f"Invalid shard {spec}: expected K/N with 1 <= K <= N")
+    return shard, shards
+
+
+# output file (or Parquet dataset) of a shard, e.g. invoices.shard-2-of-4.csv
+def shard_output(output, shard, shards):
+    base, ext = os.path.splitext(output)
+    return f"{base}.shard-{shard}-of-{shards}{ext}"
+
+
+# append-only processing journal: one fsync'd JSON line per finished document, keyed by the path relative to the
+# data folder and the content hash; the latest entry of each document is kept in memory for O(1) lookups
+class ProcessingJournal:
+    def __init__(self, journal_file, root, retry_failed="*"):
+        self.journal_file = journal_file
+        self.root = root
+        # failed documents matching this pattern (relative path) are processed again
+        self.retry_failed = retry_failed
+        self.entries = {}
+        if os.path.isfile(journal_file):
+            self.load()
+        self.file = open(journal_file, "a")
+
+    def load(self):
+        valid = 0
+        with open(self.journal_file, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a torn last line of a crashed run
+                    break
+                self.entries[entry["path"]] = entry
+                valid += len(line)
+        if valid != os.path.getsize(self.journal_file):
+            print(f"Truncating incomplete journal entry in {self.journal_file}")
+            os.truncate(self.journal_file, valid)
+
+    def relative_path(self, path):
+        return relative_path(path, self.root)
+
+    # check if the document is done (and unchanged) or failed and not selected for a retry
+    def skip(self, path):
+        entry = self.entries.get(self.relative_path(path))
+        if entry is None:
+            return False
+        if entry["status"] == "failed":
+            return not (self.retry_failed and fnmatch.fnmatch(entry["path"], self.retry_failed))
+        if entry["hash"] is None:
+            return False
+        size, mtime = file_signature(path)
+        if (size, mtime) == (entry["size"], entry["mtime"]):
+            return True
+        # the file was touched, process it again only if its content changed
+        return file_hash(path) == entry["hash"]
+
+    # record the result of a document (done or failed)
+    def record(self, path, status, error=None):
+        self.append([self.entry(path, status, error)])
+
+    # entry of a document; a document moved or deleted since it was parsed is recorded without its signature (and
+    # processed again if it comes back)
+    def entry(self, path, status, error=None):
+        relative_path = self.relative_path(path)
+        previous = self.entries.get(relative_path, {})
+        try:
+            (size, mtime), digest = file_signature(path), file_hash(path)
+        except FileNotFoundError:
+            size, mtime, digest = None, None, None
+        return {"path": relative_path, "hash": digest, "size": size, "mtime": mtime, "status": status,
+                "attempts": previous.get("attempts", 0) + 1, "error": error, "time": time.time()}
+
+    def append(self, entries):
+        for entry in entries:
+            self.entries[entry["path"]] = entry
+            self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # record the documents of an output written without a journal as done, once, when the journal is created next
+    # to it: the PDF files of the data folder are matched by file name and payer id (of the parent folder)
+    def import_output(self, output):
+        with open(output, newline="") as f:
+            rows = {(row["file_name"], row.get("doit_payer_id")) for row in csv.DictReader(f)}
+        entries = []
+        for path in iter_pdf_files(self.root):
+            folder = os.path.basename(os.path.dirname(path)).split("_")
+            payer_id = folder[1] if len(folder) > 1 else None
+            if (os.path.basename(path), payer_id) in rows:
+                entries.append(self.entry(path, "done"))
+        self.append(entries)
+        print(f"Imported {len(entries)} processed documents of {output} into {self.journal_file}")
+
+    def summary(self):
+        statuses = collections.Counter(entry["status"] for entry in self.entries.values())
+        return f"Journal: {statuses['done']} documents done, {statuses['failed']} failed"
+
+    def close(self):
+        self.file.close()
+
+
+# remove a torn last line of the output CSV file left by a crashed run
+def repair_output(output):
+    if not os.path.isfile(output) or os.path.getsize(output) == 0:
+        return
+    with open(output, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) == b"\n":
+            return
+        f.seek(0)
+        end = f.read().rfind(b"\n") + 1
+        print(f"Truncating incomplete last row of {output}")
+        f.truncate(end)
 
 
 # get sorted column values from a CSV file
@@ -115,174 +561,1839 @@ def get_sorted_column_values(file_name, column_index):
     return column_values
 
 
-# extract data from the document
-async def extract_data(model, document, sem):
-    async with sem:
-        # Update the prompt to match the new query and desired format.
+# prompt template for the extraction, filled with the parsing instructions, the format instructions and the invoice
+PROMPT_TEMPLATE = textwrap.dedent(
+    """
+    Act as an accountant and extract data from the following document into a flat JSON object. The output should be formatted as a JSON instance that conforms to the provided JSON schema.
+
+    {instructions}
+
+    {format_instructions}
+
+    <document>
+    {invoice}
+    <document>
+
+    JSON:
+    """
+)
+
+# parsing instructions for the extraction
+PARSING_INSTRUCTIONS = textwrap.dedent(
+    """
+    **Important Instructions:**
+    1. Classify the document as 'Invoice' if it primarily details charges. Classify as 'Credit Note' if it contains references to 'Credit Memo', 'Credit Adjustment Note', 'Tax Invoice Adjustment', or similar terms. Additionally, consider the net total amount; classify as 'Credit Note' only if the net charges after credits/discounts are negative.
+    2. Implement a validation step to accurately determine the document type ('Invoice' or 'Credit Note') based on the presence of specific keywords and the net total amount. If the document lacks explicit credit-related terms but has a net zero or positive amount, classify it as 'Invoice'.
+    3. The total amount should reflect the net outcome of all charges and credits. Record as 0 if charges are fully offset by credits, rather than summing up the individual credit amounts. Use negative values for credits.
+    4. Ensure that both the total amount and the total VAT amount are negative for credits to accurately reflect credit transactions.
+    5. Net charges should be negative for credits, indicating a refund or credit situation.
+    6. Extract the `total_vat_tax_amount` specifically from the section labeled "TOTAL VAT" or "TOTAL Tax". This amount should be taken from the line immediately following this label, formatted as "{currency} {number}".
+    7. The total VAT or tax amount should accurately reflect the net VAT or tax charges after applying any credits. Record as 0 if the net VAT or tax charge is zero.
+    8. Correct negative zero values (-0.0) to positive zero (0.0) for fields like `total_amount`, `total_vat_tax_amount`, `net_charges_usd`, and `net_charges_non_usd` to ensure data accuracy and avoid confusion.
+    9. Convert all dates to the "Month name Day, Year" format with no leading zeros to maintain consistency across documents.
+    10. Ensure all dates are formatted according to the "Month name Day, Year" format with no leading zeros for uniformity.
+    11. Convert all instances of alpha-2 country codes to their full country name equivalents to enhance readability and clarity.
+    12. The branch name should exclude the full company name and should not resemble a full address, to maintain focus on relevant details.
+    13. Monitor charges and amount signs carefully; they are typically negative for credits, reflecting the nature of the transaction.
+    14. Extract the exchange rate from the pattern "1 USD = X currency" to facilitate accurate financial calculations.
+    15. Format all numbers without commas (e.g., use 2200.58 instead of 2,200.58) for consistency and to avoid parsing errors.
+    16. The billing address company cannot be the AWS company name. Ensure that the billing address company is the first line of the address before the ATTN line.
+    17. Use city names to figure out the billing address country (not city), if the country name is not provided or cannot be determined.
+    18. When net charges in non-USD currency are not found in the document, try to extract it from the total invoice amount in non-USD currency, if available.
+    19. To determine if an invoice is for a Reserved Instance (RI), check for the presence of the phrase '(one time fee)' next to any of the service charges. If this phrase is present, classify the invoice as an RI invoice by setting the `ri_invoice` field to True. If this phrase is not found, set the `ri_invoice` field to None.
+    """
+)
+
+
+# prompt template for the extraction of several packed documents in one request
+BATCH_PROMPT_TEMPLATE = textwrap.dedent(
+    """
+    Act as an accountant and extract data from each of the following documents into a JSON object with one flat record per document in the `invoices` list, in the order of the documents. The output should be formatted as a JSON instance that conforms to the provided JSON schema. Keep the file name and the DoiT payer id of each document in its record.
+
+    {instructions}
+
+    {format_instructions}
+
+    {invoice}
+
+    JSON:
+    """
+)
+
+
+# records of several documents extracted in one request
+class AwsInvoiceCreditBatch(BaseModel):
+    invoices: List[AwsInvoiceCredit] = Field(description="One record per document, in the order of the documents.")
+
+
+# split a scanned document into file name, DoiT payer id and invoice text
+def split_document(document):
+    file_line, payer_line, invoice = document.split("\n", 2)
+    return file_line.split(":", 1)[1].strip(), payer_line.split(":", 1)[1].strip(), invoice
+
+
+# fingerprint of everything besides the invoice text that affects the extraction result
+def extraction_fingerprint(service, model_name, kwargs, fast_path="off", cascade_model=None):
+    data = {
+        "service": service,
+        "model": model_name,
+        "kwargs": kwargs,
+        "prompt": PROMPT_TEMPLATE,
+        "instructions": PARSING_INSTRUCTIONS,
+        "schema": AwsInvoiceCredit.model_json_schema(),
+    }
+    # fields taken from the fast path instead of the LLM depend on the patterns
+    if fast_path == "on":
+        data["fast_path"] = {name: pattern.pattern for name, pattern in FAST_PATH_PATTERNS.items()}
+    # results accepted from the first tier of a cascade come from the cheaper model
+    if cascade_model:
+        data["cascade_model"] = cascade_model
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+# persistent content-addressed cache of validated extraction results (SQLite)
+class ExtractionCache:
+    def __init__(self, cache_dir, fingerprint, max_entries=0, max_age_days=0):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(cache_dir, "extractions.sqlite"), isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS extractions "
+                        "(key TEXT PRIMARY KEY, record TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self.duplicates = 0
+        # extractions in flight, so identical documents are sent to the LLM only once per run
+        self.pending = {}
+        self.evict(max_entries, max_age_days)
+
+    # remove entries older than max_age_days and the least recently used entries above max_entries
+    def evict(self, max_entries=0, max_age_days=0):
+        if max_age_days:
+            self.db.execute("DELETE FROM extractions WHERE created < ?", (time.time() - max_age_days * 86400,))
+        if max_entries:
+            self.db.execute("DELETE FROM extractions WHERE key NOT IN "
+                            "(SELECT key FROM extractions ORDER BY accessed DESC LIMIT ?)", (max_entries,))
+
+    # the file name and payer id are not part of the key, so identical PDFs in several payer folders share an entry
+    def key(self, invoice):
+        return hashlib.sha256(f"{self.fingerprint}\n{invoice}".encode()).hexdigest()
+
+    def get(self, key):
+        row = self.db.execute("SELECT record FROM extractions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE extractions SET accessed = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, record):
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO extractions (key, record, created, accessed) VALUES (?, ?, ?, ?)",
+                        (key, json.dumps(record), now, now))
+
+    # return the cached result for the document or run extract() and cache its result
+    async def get_or_extract(self, document, extract):
+        file_name, payer_id, invoice = split_document(document)
+        update = {"file_name": file_name, "doit_payer_id": payer_id}
+        key = self.key(invoice)
+        # a failed attempt is taken over by one of its duplicates, the others wait for that one
+        while key in self.pending:
+            result = await asyncio.shield(self.pending[key])
+            if not isinstance(result, Exception):
+                self.duplicates += 1
+                return result.model_copy(update=update)
+        record = self.get(key)
+        if record is not None:
+            self.hits += 1
+            record_span(cache_hits=1)
+            return AwsInvoiceCredit(**{**record, **update})
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            result = await extract()
+            if not isinstance(result, Exception):
+                self.put(key, result.model_dump())
+            future.set_result(result)
+            return result
+        finally:
+            if not future.done():
+                future.set_result(Exception(f"Error processing document {file_name}: extraction cancelled"))
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+    def summary(self):
+        return f"Cache hits: {self.hits}, misses: {self.misses}, duplicates: {self.duplicates}"
+
+    def close(self):
+        self.db.close()
+
+
+# timings, token usage, retries and errors of the extraction of a single document
+class DocumentSpan:
+    def __init__(self, path, parse_time=0.0, raw_tokens=None, text_tokens=None):
+        self.path = path
+        self.parse_time = parse_time
+        # estimated tokens of the document text before and after preprocessing (if enabled)
+        self.raw_tokens = raw_tokens
+        self.text_tokens = text_tokens
+        # the document is ready for extraction once it is parsed
+        self.ready = time.monotonic()
+        self.started = None
+        self.duration = 0.0
+        # time spent waiting for a worker and for the rate limiter (or semaphore)
+        self.queue_wait = 0.0
+        self.llm_latency = 0.0
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+        self.cache_hits = 0
+        # duplicate requests sent for the straggling requests of the document
+        self.hedges = 0
+        # errors of all requests and response parsing attempts, and the error the extraction failed with
+        self.errors = []
+        self.error = None
+        self.status = None
+
+    # add this document's share of a request packing several documents
+    def add_share(self, other, documents):
+        self.queue_wait += other.queue_wait
+        self.llm_latency += other.llm_latency
+        self.requests += other.requests / documents
+        self.prompt_tokens += other.prompt_tokens / documents
+        self.completion_tokens += other.completion_tokens / documents
+        self.retries += other.retries / documents
+        self.errors += other.errors
+
+    def to_dict(self):
+        return {"path": self.path, "status": self.status, "error": self.error, "errors": self.errors,
+                "parse_time": round(self.parse_time, 4), "raw_tokens": self.raw_tokens,
+                "text_tokens": self.text_tokens, "queue_wait": round(self.queue_wait, 4),
+                "llm_latency": round(self.llm_latency, 4), "duration": round(self.duration, 4),
+                "requests": self.requests, "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens, "retries": self.retries, "cache_hits": self.cache_hits,
+                "hedges": self.hedges}
+
+
+# span of the document being extracted by the current task
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+
+
+# add to the counters of the span of the document being extracted (no-op outside of a span)
+def record_span(**counters):
+    span = CURRENT_SPAN.get()
+    if span is not None:
+        for name, value in counters.items():
+            setattr(span, name, getattr(span, name) + value)
+
+
+# record a failed request or response parsing attempt in the span of the document being extracted
+def record_error(error):
+    span = CURRENT_SPAN.get()
+    if span is not None:
+        span.errors.append(type(error).__name__)
+
+
+# run the coroutine within the span of a document; must run in a task of its own (e.g. through asyncio.gather)
+async def run_in_span(span, coroutine):
+    CURRENT_SPAN.set(span)
+    return await coroutine
+
+
+# share of the --tpm/--rpm quota the rate limiter aims for, leaving headroom for estimation errors
+QUOTA_UTILIZATION = 0.95
+# expected number of completion tokens of a single extraction (the JSON record)
+COMPLETION_TOKENS_ESTIMATE = 600
+# with a --tpm/--rpm budget, the concurrency limit is decreased when the average latency exceeds the median latency
+# of the recent requests by this factor
+LATENCY_FACTOR = 2.0
+# number of recent request latencies the median baseline is computed from, and the minimum before it is used
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+# maximum backoff between retries (seconds)
+MAX_BACKOFF = 60
+
+
+# estimate the number of tokens of a text (about 4 characters per token)
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+# status code and headers of an error raised by the OpenAI (httpx) or Bedrock (botocore) client
+def error_response(error):
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        metadata = response.get("ResponseMetadata", {})
+        return metadata.get("HTTPStatusCode"), metadata.get("HTTPHeaders", {})
+    return getattr(error, "status_code", getattr(response, "status_code", None)), getattr(response, "headers", None) or {}
+
+
+# check if the request was throttled by the provider (HTTP 429 or a throttling error code)
+def is_throttled(error):
+    status, _ = error_response(error)
+    return status == 429 or any(marker in f"{type(error).__name__} {error}"
+                                for marker in ("RateLimit", "Throttling", "TooManyRequests"))
+
+
+# check if the request failed for a reason that may go away on retry (timeouts, connection errors, server errors)
+def is_transient(error):
+    status, _ = error_response(error)
+    return (status is not None and status >= 500) or isinstance(error, (asyncio.TimeoutError, ConnectionError)) or any(
+        marker in f"{type(error).__name__} {error}"
+        for marker in ("APIConnectionError", "APITimeoutError", "ServiceUnavailable", "ModelTimeout", "InternalServerError"))
+
+
+# number of seconds to wait as requested by the provider (Retry-After header), None if not provided
+def retry_after(error):
+    _, headers = error_response(error)
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+# token bucket refilled at rate_per_minute, holding up to 10 seconds of quota to keep bursts within the limit
+class TokenBucket:
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60
+        self.capacity = rate_per_minute / 6
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # seconds to wait until amount can be taken; requests larger than the capacity only wait for a full bucket
+    def wait_time(self, amount, now):
+        self.refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount):
+        self.level -= amount
+
+
+# schedule LLM requests within the tokens/requests per minute budget, retry throttled and failed requests with
+# jittered backoff and adapt the number of requests in flight (AIMD) to the observed latency and throttling
+class RateLimiter:
+    def __init__(self, max_concurrency, tpm=0, rpm=0, max_retries=5, min_concurrency=1):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.max_retries = max_retries
+        self.tokens = TokenBucket(tpm * QUOTA_UTILIZATION) if tpm else None
+        self.requests = TokenBucket(rpm * QUOTA_UTILIZATION) if rpm else None
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.latency = None
+        self.recent_latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.last_decrease = 0.0
+        self.lock = asyncio.Lock()
+        self.released = asyncio.Event()
+        self.completed = 0
+        self.throttled = 0
+        self.retries = 0
+
+    # wait until a request of the given size fits into the budget and the concurrency limit (first come, first served)
+    async def acquire(self, tokens):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if self.tokens is not None:
+                    wait = max(wait, self.tokens.wait_time(tokens, now))
+                if self.requests is not None:
+                    wait = max(wait, self.requests.wait_time(1, now))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                elif self.in_flight >= int(self.limit):
+                    self.released.clear()
+                    await self.released.wait()
+                else:
+                    break
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            if self.requests is not None:
+                self.requests.take(1)
+            self.in_flight += 1
+
+    # finish a request: additive increase on success, multiplicative decrease on throttling or, when a budget is
+    # configured, on latency growing above the recent baseline (without a budget --concurrency stays the ceiling)
+    def release(self, latency=None, throttled=False):
+        self.in_flight -= 1
+        now = time.monotonic()
+        # decrease at most once per request duration, so a burst of failures counts as a single congestion signal
+        can_decrease = now - self.last_decrease > (self.latency or 1.0)
+        if throttled:
+            self.throttled += 1
+            if can_decrease:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self.last_decrease = now
+        elif latency is not None:
+            self.completed += 1
+            self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+            self.recent_latencies.append(latency)
+            if self.latency_grows() and can_decrease:
+                self.limit = max(self.min_concurrency, self.limit * 0.9)
+                self.last_decrease = now
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+        self.released.set()
+
+    # the average latency exceeds the median of the recent latencies (the baseline follows the normal spread and
+    # slow drifts of the provider latency); only checked when a --tpm/--rpm budget is configured
+    def latency_grows(self):
+        if (self.tokens is None and self.requests is None) or len(self.recent_latencies) < LATENCY_MIN_SAMPLES:
+            return False
+        return self.latency > LATENCY_FACTOR * percentile(sorted(self.recent_latencies), 0.5)
+
+    # correct the token budget once the actual usage of a request is known
+    def adjust_tokens(self, estimated, actual):
+        if self.tokens is not None and actual:
+            self.tokens.take(actual - estimated)
+
+    # stop sending new requests for the given number of seconds
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # run the request (a coroutine function) within the limits, retrying throttled and transient errors
+    async def run(self, request, tokens):
+        for attempt in itertools.count():
+            queued = time.monotonic()
+            await self.acquire(tokens)
+            start = time.monotonic()
+            record_span(queue_wait=start - queued)
+            try:
+                result = await request()
+            except asyncio.CancelledError:
+                # e.g. the losing request of a hedged pair
+                self.release()
+                raise
+            except Exception as e:
+                throttled = is_throttled(e)
+                self.release(throttled=throttled)
+                if attempt >= self.max_retries or not (throttled or is_transient(e)):
+                    raise
+                self.retries += 1
+                record_span(retries=1)
+                delay = retry_after(e)
+                if delay is None:
+                    # exponential backoff with full jitter
+                    delay = random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+                elif throttled:
+                    # the provider asked all requests to wait
+                    self.pause(delay)
+                await asyncio.sleep(delay + random.uniform(0, 0.1 * delay))
+                continue
+            self.release(time.monotonic() - start)
+            return result
+
+    def summary(self):
+        return (f"Requests completed: {self.completed}, throttled: {self.throttled}, retries: {self.retries}, "
+                f"concurrency limit: {self.limit:.1f}")
+
+
+# prompt tokens, completion tokens and prompt tokens served from the provider's prompt cache of an LLM response
+def token_usage(message):
+    usage = getattr(message, "usage_metadata", None) or {}
+    metadata = getattr(message, "response_metadata", None) or {}
+    token_usage = metadata.get("token_usage") or metadata.get("usage") or {}
+    prompt_tokens = usage.get("input_tokens", token_usage.get("prompt_tokens", token_usage.get("input_tokens", 0)))
+    completion_tokens = usage.get("output_tokens",
+                                  token_usage.get("completion_tokens", token_usage.get("output_tokens", 0)))
+    cached_tokens = (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens",
+                                                                         token_usage.get("cache_read_input_tokens", 0))
+    return prompt_tokens or 0, completion_tokens or 0, cached_tokens or 0
+
+
+# parser and prompt of the extraction, built once per model and schema and shared by all documents
+class ExtractionChain:
+    def __init__(self, model, schema=AwsInvoiceCredit, template=PROMPT_TEMPLATE):
+        self.model = model
+        self.parser = PydanticOutputParser(pydantic_object=schema)
+        # render the static part of the prompt once; the instructions and the JSON schema come first, so all
+        # requests share the same prefix and the provider's prompt caching applies to it
+        marker = "\0invoice\0"
+        prompt = template.format(instructions=PARSING_INSTRUCTIONS,
+                                 format_instructions=self.parser.get_format_instructions(), invoice=marker)
+        self.prefix, self.suffix = prompt.split(marker)
+        # chains asking only for the fields not found by the fast path, by field names
+        self.residual_chains = {}
+        self.documents = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.overhead = 0.0
+
+    def render(self, document):
+        return self.prefix + document + self.suffix
+
+    # chain for the same model asking only for the given fields of AwsInvoiceCredit
+    def residual(self, fields):
+        key = tuple(fields)
+        if key not in self.residual_chains:
+            schema = create_model("AwsInvoiceCreditResidual",
+                                  **{name: (AwsInvoiceCredit.model_fields[name].annotation, AwsInvoiceCredit.model_fields[name])
+                                     for name in fields})
+            self.residual_chains[key] = ExtractionChain(self.model, schema)
+        return self.residual_chains[key]
+
+    # send the document (or `documents` packed documents) to the model and parse the response, through the rate
+    # limiter if provided
+    async def ainvoke(self, document, sem, documents=1):
+        start = time.perf_counter()
+        prompt = self.render(document)
+        self.overhead += time.perf_counter() - start
+        tokens = estimate_tokens(prompt) + documents * COMPLETION_TOKENS_ESTIMATE
+        if isinstance(sem, RateLimiter):
+            message = await sem.run(lambda: self.call_model(prompt), tokens)
+        else:
+            queued = time.monotonic()
+            async with sem:
+                record_span(queue_wait=time.monotonic() - queued)
+                message = await self.call_model(prompt)
+        prompt_tokens, completion_tokens, cached_tokens = token_usage(message)
+        if isinstance(sem, RateLimiter):
+            sem.adjust_tokens(tokens, prompt_tokens + completion_tokens)
+        self.documents += documents
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cached_tokens += cached_tokens
+        record_span(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        start = time.perf_counter()
         try:
-            # Instantiate the parser with the new model.
-            parser = PydanticOutputParser(pydantic_object=AwsInvoiceCredit)
-            # Get the file name from the first line of the document
-            file_name = document.split("\n")[0].split(":")[1].strip()
-            # Update the prompt to match the new query and desired format.
-            prompt = PromptTemplate(
-                template=textwrap.dedent(
-                    """
-                    Act as an accountant and extract data from the following document into a flat JSON object. The output should be formatted as a JSON instance that conforms to the provided JSON schema.
-                    
-                    {instructions}
-                    
-                    {format_instructions}
-                    
-                    <document>
-                    {invoice}
-                    <document>
-                    
-                    JSON:
-                    """
-                ),
-                input_variables=["request", "invoice"],
-                partial_variables={
-                    "format_instructions": parser.get_format_instructions(),
-                },
-            )
-            # Generate the input using the updated prompt.
-            parsing_instructions = textwrap.dedent(
-                """
-                **Important Instructions:**
-                1. Classify the document as 'Invoice' if it primarily details charges. Classify as 'Credit Note' if it contains references to 'Credit Memo', 'Credit Adjustment Note', 'Tax Invoice Adjustment', or similar terms. Additionally, consider the net total amount; classify as 'Credit Note' only if the net charges after credits/discounts are negative.
-                2. Implement a validation step to accurately determine the document type ('Invoice' or 'Credit Note') based on the presence of specific keywords and the net total amount. If the document lacks explicit credit-related terms but has a net zero or positive amount, classify it as 'Invoice'.
-                3. The total amount should reflect the net outcome of all charges and credits. Record as 0 if charges are fully offset by credits, rather than summing up the individual credit amounts. Use negative values for credits.
-                4. Ensure that both the total amount and the total VAT amount are negative for credits to accurately reflect credit transactions.
-                5. Net charges should be negative for credits, indicating a refund or credit situation.
-                6. Extract the `total_vat_tax_amount` specifically from the section labeled "TOTAL VAT" or "TOTAL Tax". This amount should be taken from the line immediately following this label, formatted as "{currency} {number}".
-                7. The total VAT or tax amount should accurately reflect the net VAT or tax charges after applying any credits. Record as 0 if the net VAT or tax charge is zero.
-                8. Correct negative zero values (-0.0) to positive zero (0.0) for fields like `total_amount`, `total_vat_tax_amount`, `net_charges_usd`, and `net_charges_non_usd` to ensure data accuracy and avoid confusion.
-                9. Convert all dates to the "Month name Day, Year" format with no leading zeros to maintain consistency across documents.
-                10. Ensure all dates are formatted according to the "Month name Day, Year" format with no leading zeros for uniformity.
-                11. Convert all instances of alpha-2 country codes to their full country name equivalents to enhance readability and clarity.
-                12. The branch name should exclude the full company name and should not resemble a full address, to maintain focus on relevant details.
-                13. Monitor charges and amount signs carefully; they are typically negative for credits, reflecting the nature of the transaction.
-                14. Extract the exchange rate from the pattern "1 USD = X currency" to facilitate accurate financial calculations.
-                15. Format all numbers without commas (e.g., use 2200.58 instead of 2,200.58) for consistency and to avoid parsing errors.
-                16. The billing address company cannot be the AWS company name. Ensure that the billing address company is the first line of the address before the ATTN line.
-                17. Use city names to figure out the billing address country (not city), if the country name is not provided or cannot be determined.
-                18. When net charges in non-USD currency are not found in the document, try to extract it from the total invoice amount in non-USD currency, if available.
-                19. To determine if an invoice is for a Reserved Instance (RI), check for the presence of the phrase '(one time fee)' next to any of the service charges. If this phrase is present, classify the invoice as an RI invoice by setting the `ri_invoice` field to True. If this phrase is not found, set the `ri_invoice` field to None.
-                """
-            )
-            # Create a runnable chain
-            chain = (
-                    {"instructions": RunnablePassthrough(), "invoice": RunnablePassthrough()}
-                    | prompt
-                    | model
-                    | parser
-            )
-
-            # Invoke the chain
-            parsed = await chain.ainvoke({"instructions": parsing_instructions, "invoice": document})
-            return parsed
+            return self.parser.parse(message.content)
         except Exception as e:
-            # returning and not raising the exception to continue processing other documents
-            return Exception(f"Error processing document {file_name}: {e}")
+            record_error(e)
+            raise
+        finally:
+            self.overhead += time.perf_counter() - start
+
+    # send the prompt to the model, recording the request in the span of the document
+    async def call_model(self, prompt):
+        start = time.monotonic()
+        sent = REQUEST_SENT.get()
+        if sent is not None and not sent.done():
+            sent.set_result(start)
+        try:
+            return await self.model.ainvoke(prompt)
+        except Exception as e:
+            record_error(e)
+            raise
+        finally:
+            record_span(requests=1, llm_latency=time.monotonic() - start)
+
+    # token usage and overhead of this chain and its residual chains, together with the other chains if given
+    def summary(self, *others):
+        chains = [self, *self.residual_chains.values(), *others]
+        documents = sum(chain.documents for chain in chains)
+        overhead = 1000 * sum(chain.overhead for chain in chains) / documents if documents else 0.0
+        return (f"Prompt tokens: {sum(chain.prompt_tokens for chain in chains)} "
+                f"(cached: {sum(chain.cached_tokens for chain in chains)}), "
+                f"completion tokens: {sum(chain.completion_tokens for chain in chains)}, "
+                f"prompt/parser overhead: {overhead:.2f} ms/document")
+
+
+# pack several documents into one request and return the records by file name and payer id; documents missing
+# from the response, or all of them if the response is malformed, are sent again as single-document requests
+class RequestPacker:
+    def __init__(self, chain, docs_per_request, max_wait=0.5):
+        self.chain = chain
+        self.batch_chain = ExtractionChain(chain.model, AwsInvoiceCreditBatch, BATCH_PROMPT_TEMPLATE)
+        self.docs_per_request = docs_per_request
+        # seconds to wait for more documents before sending an incomplete request
+        self.max_wait = max_wait
+        self.waiting = []
+        self.timer = None
+        self.tasks = set()
+        self.requests = 0
+        self.fallbacks = 0
+
+    # same interface as ExtractionChain.ainvoke: the document is sent as soon as the request is full
+    async def ainvoke(self, document, sem):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append((document, future, CURRENT_SPAN.get()))
+        if len(self.waiting) >= self.docs_per_request:
+            self.flush(sem)
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self.flush, sem)
+        return await future
+
+    def residual(self, fields):
+        return self.chain.residual(fields)
+
+    def flush(self, sem):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.waiting = self.waiting, []
+        if batch:
+            task = asyncio.ensure_future(self.send(batch, sem))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def send(self, batch, sem):
+        records = {}
+        if len(batch) > 1:
+            self.requests += 1
+            documents = "\n".join(f"<document>\n{document}\n</document>" for document, _, _ in batch)
+            # the packed request is recorded in a span of its own and shared by the documents
+            shared = DocumentSpan(None)
+            CURRENT_SPAN.set(shared)
+            try:
+                result = await self.batch_chain.ainvoke(documents, sem, len(batch))
+                records = {(record.file_name, record.doit_payer_id): record for record in result.invoices}
+            except Exception as e:
+                print(f"Error processing packed request, falling back to single documents: {e}")
+            for _, _, span in batch:
+                if span is not None:
+                    span.add_share(shared, len(batch))
+        fallbacks = []
+        for document, future, span in batch:
+            file_name, payer_id, _ = split_document(document)
+            record = records.get((file_name, payer_id))
+            if record is not None:
+                future.set_result(record)
+            else:
+                fallbacks.append((document, future, span))
+        self.fallbacks += len(fallbacks) if len(batch) > 1 else 0
+        results = await asyncio.gather(*[run_in_span(span, self.chain.ainvoke(document, sem))
+                                         for document, _, span in fallbacks], return_exceptions=True)
+        for (_, future, _), result in zip(fallbacks, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def summary(self):
+        return (self.chain.summary(self.batch_chain) + "\n" +
+                f"Packed requests: {self.requests}, documents sent again as single requests: {self.fallbacks}")
+
+
+# future of the current hedged attempt, resolved with the time its request is sent (after the rate limiter)
+REQUEST_SENT = contextvars.ContextVar("request_sent", default=None)
+
+
+# send a duplicate of a single-document request that is still running after the `share` percentile of the latency
+# of recent requests, return the first valid result and cancel the other request; at most `budget` of the requests
+# are hedged, the duplicates go through the rate limiter like any request so they stay within the quota
+class RequestHedger:
+    def __init__(self, chain, share=0.95, budget=0.05, min_samples=20, window=1000):
+        self.chain = chain
+        self.share = share
+        self.budget = budget
+        # no hedging until enough latencies are known
+        self.min_samples = min_samples
+        # latencies of the recent requests from sending to a valid result
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.over_budget = 0
+        self.residual_chains = {}
+
+    # the packed requests of a RequestPacker wrapping the hedger use the model of the chain
+    @property
+    def model(self):
+        return self.chain.model
+
+    # hedged chain asking only for the given fields (with latencies and budget of its own)
+    def residual(self, fields):
+        key = tuple(fields)
+        if key not in self.residual_chains:
+            self.residual_chains[key] = RequestHedger(self.chain.residual(fields), self.share, self.budget,
+                                                      self.min_samples)
+        return self.residual_chains[key]
+
+    def threshold(self):
+        if len(self.latencies) < self.min_samples:
+            return None
+        return percentile(sorted(self.latencies), self.share)
+
+    # one attempt in a task of its own, reporting when its request is sent
+    async def attempt(self, document, sem, sent):
+        REQUEST_SENT.set(sent)
+        result = await self.chain.ainvoke(document, sem)
+        self.latencies.append(time.monotonic() - sent.result())
+        return result
+
+    async def ainvoke(self, document, sem):
+        loop = asyncio.get_running_loop()
+        self.requests += 1
+        sent = loop.create_future()
+        attempts = [asyncio.ensure_future(self.attempt(document, sem, sent))]
+        try:
+            await asyncio.wait([attempts[0], sent], return_when=asyncio.FIRST_COMPLETED)
+            threshold = self.threshold()
+            if not attempts[0].done() and threshold is not None:
+                await asyncio.wait(attempts, timeout=max(0.0, threshold - (time.monotonic() - sent.result())))
+                if not attempts[0].done():
+                    if self.hedged < self.budget * self.requests:
+                        self.hedged += 1
+                        record_span(hedges=1)
+                        attempts.append(asyncio.ensure_future(self.attempt(document, sem, loop.create_future())))
+                    else:
+                        self.over_budget += 1
+            # the first valid result wins, the result of the first attempt if both fail
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in attempts:
+                    if attempt in done and attempt.exception() is None:
+                        self.hedge_wins += attempt is not attempts[0]
+                        return attempt.result()
+            return attempts[0].result()
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    # summary of the chain (together with the other chains if given) and of the hedged requests
+    def summary(self, *others):
+        threshold = self.threshold()
+        threshold = f"{threshold:.2f} s" if threshold is not None else "not enough samples"
+        requests = self.requests + sum(chain.requests for chain in self.residual_chains.values())
+        hedged = self.hedged + sum(chain.hedged for chain in self.residual_chains.values())
+        wins = self.hedge_wins + sum(chain.hedge_wins for chain in self.residual_chains.values())
+        over_budget = self.over_budget + sum(chain.over_budget for chain in self.residual_chains.values())
+        return (self.chain.summary(*others) + "\n" +
+                f"Hedged requests: {hedged}/{requests} (budget: {self.budget:.0%}), won by the hedge: {wins}, "
+                f"not hedged over budget: {over_budget}, p{100 * self.share:g} threshold: {threshold}")
+
+
+# document type keywords of credit notes
+CREDIT_NOTE_KEYWORDS = ["credit memo", "credit adjustment note", "tax invoice adjustment", "credit note"]
+
+# country names of alpha-2 country codes found at the end of billing addresses
+COUNTRY_NAMES = {
+    "AE": "United Arab Emirates", "AR": "Argentina", "AT": "Austria", "AU": "Australia", "BE": "Belgium",
+    "BG": "Bulgaria", "BR": "Brazil", "CA": "Canada", "CH": "Switzerland", "CL": "Chile", "CN": "China",
+    "CO": "Colombia", "CY": "Cyprus", "CZ": "Czech Republic", "DE": "Germany", "DK": "Denmark", "EE": "Estonia",
+    "ES": "Spain", "FI": "Finland", "FR": "France", "GB": "United Kingdom", "GR": "Greece", "HK": "Hong Kong",
+    "HR": "Croatia", "HU": "Hungary", "ID": "Indonesia", "IE": "Ireland", "IL": "Israel", "IN": "India",
+    "IT": "Italy", "JP": "Japan", "KR": "South Korea", "LT": "Lithuania", "LU": "Luxembourg", "LV": "Latvia",
+    "MT": "Malta", "MX": "Mexico", "MY": "Malaysia", "NL": "Netherlands", "NO": "Norway", "NZ": "New Zealand",
+    "PE": "Peru", "PH": "Philippines", "PL": "Poland", "PT": "Portugal", "RO": "Romania", "RS": "Serbia",
+    "SA": "Saudi Arabia", "SE": "Sweden", "SG": "Singapore", "SI": "Slovenia", "SK": "Slovakia", "TH": "Thailand",
+    "TR": "Turkey", "TW": "Taiwan", "UA": "Ukraine", "US": "United States", "VN": "Vietnam", "ZA": "South Africa",
+}
+
+# patterns of the structurally fixed fields of AWS invoices
+DATE_PATTERN = r"[A-Z][a-z]+\.? \d{1,2}\s*,\s*\d{4}"
+DOCUMENT_LABEL = r"(?<!Original )(?:Invoice|Credit Memo|Credit Note|Credit Adjustment Note|Tax Invoice Adjustment)"
+FAST_PATH_PATTERNS = {
+    "invoice_number": re.compile(DOCUMENT_LABEL + r" Number:?\s*([A-Z0-9][A-Z0-9-]{3,})\b"),
+    "invoice_date": re.compile(DOCUMENT_LABEL + r" Date:?\s*(" + DATE_PATTERN + ")"),
+    "original_invoice_number": re.compile(r"Original Invoice Number:?\s*([A-Z0-9][A-Z0-9-]{3,})\b"),
+    "original_invoice_date": re.compile(r"Original Invoice Date:?\s*(" + DATE_PATTERN + ")"),
+    "allocation_number": re.compile(r"Allocation Number:?\s*(\d+)\b"),
+    "aws_account_number": re.compile(r"Account (?:Number|number|#):?\s*(\d{4}-?\d{4}-?\d{4})\b"),
+    "billing_period": re.compile(r"[Bb]illing [Pp]eriod:?\s*([A-Z][a-z]+\.? \d{1,2}(?:\s*,\s*\d{4})?)\s*-\s*(" + DATE_PATTERN + ")"),
+    "total_amount": re.compile(r"TOTAL AMOUNT(?: DUE)?(?: ON " + DATE_PATTERN + r")?:?\s*(-?)\s*(?:\$|([A-Z]{3}))\s*(-?[\d,]+\.\d+)"),
+    "total_vat_tax": re.compile(r"TOTAL (?:VAT|Tax|TAX|GST|HST)\b[^\n]*\n\s*(-?)\s*([A-Z]{3})\s*(-?[\d,]+\.\d+)"),
+    "exchange_rate": re.compile(r"1 USD = ([\d,]*\.?\d+) ?([A-Z]{3})"),
+    "amazon_company_name": re.compile(r"^\s*(Amazon (?:Web Services|AWS Servi\w+|Internet Services)\b[^\n]*?"
+                                      r"(?:Inc\.|SARL|S\.à r\.l\.|Pty Ltd\.?|LLC|G\.K\.|Limited|Ltd\.?|Ltda\.?|Sdn\.? Bhd\.?))\s*$",
+                                      re.IGNORECASE | re.MULTILINE),
+    "address": re.compile(r"Bill(?:ing)? to Address:?\s*\n([^\n]+)\n\s*ATTN:?\s*([^\n]+)\n((?:[^\n]+\n)*?)\s*Invoice Summary"),
+}
+
+
+# all matches of the pattern, None unless every match is the same (ambiguous values are left to the LLM)
+def unique_match(name, text):
+    matches = set(FAST_PATH_PATTERNS[name].findall(text))
+    return matches.pop() if len(matches) == 1 else None
+
+
+# convert a date to the "Month name Day, Year" format with no leading zeros
+def normalize_date(value):
+    value = re.sub(r"\s*,\s*", ", ", value.replace(".", ""))
+    for date_format in ("%B %d, %Y", "%b %d, %Y"):
+        try:
+            date = datetime.strptime(value, date_format)
+            return f"{date:%B} {date.day}, {date.year}"
+        except ValueError:
+            pass
+    return None
+
+
+# signed amount as printed on the invoice
+def parse_amount(sign, value):
+    amount = float(value.replace(",", ""))
+    return -abs(amount) if sign == "-" else amount
+
+
+# pre-extract the structurally fixed fields of the invoice with regular expressions; only fields matched
+# unambiguously are returned
+def pre_extract(document):
+    file_name, payer_id, text = split_document(document)
+    fields = {"file_name": file_name, "doit_payer_id": payer_id}
+    lowered = text.lower()
+
+    for name in ("invoice_number", "original_invoice_number", "allocation_number"):
+        value = unique_match(name, text)
+        if value:
+            fields[name] = value
+    for name in ("invoice_date", "original_invoice_date"):
+        value = unique_match(name, text)
+        if value and normalize_date(value):
+            fields[name] = normalize_date(value)
+    # fields confidently empty when their labels are missing
+    if "allocation" not in lowered:
+        fields["allocation_number"] = None
+    if "original" not in lowered and "replace" not in lowered:
+        fields["original_invoice_number"] = None
+        fields["original_invoice_date"] = None
+    fields["ri_invoice"] = True if "(one time fee)" in text else None
+
+    account = unique_match("aws_account_number", text)
+    if account:
+        fields["aws_account_number"] = account.replace("-", "")
+    period = unique_match("billing_period", text)
+    if period:
+        end = normalize_date(period[1])
+        # the year is often printed only once, after the end date
+        start = normalize_date(period[0] if re.search(r"\d{4}$", period[0]) else f"{period[0]}, {end[-4:]}") if end else None
+        if start and end:
+            fields["billing_period"] = f"{start} - {end}"
+    rate = unique_match("exchange_rate", text)
+    if rate:
+        fields["exchange_rate"] = float(rate[0].replace(",", ""))
+    company = unique_match("amazon_company_name", text)
+    if company:
+        fields["amazon_company_name"] = company.strip()
+    address = unique_match("address", text)
+    if address:
+        fields["address_company"] = address[0].strip()
+        fields["address_attn"] = address[1].strip()
+        lines = address[2].strip().split("\n")
+        country = lines[-1].split(",")[-1].strip() if lines[-1] else ""
+        if country.upper() in COUNTRY_NAMES:
+            fields["address_country"] = COUNTRY_NAMES[country.upper()]
+        elif country in COUNTRY_NAMES.values():
+            fields["address_country"] = country
+
+    # amounts and the document type depend on the sign, keep them only if they are consistent with the keywords
+    credit_note = any(keyword in lowered for keyword in CREDIT_NOTE_KEYWORDS)
+    total = unique_match("total_amount", text)
+    if total:
+        amount = parse_amount(total[0] or total[2][:1], total[2].lstrip("-"))
+        if credit_note == (amount < 0):
+            fields["document_type"] = "Credit Note" if credit_note else "Invoice"
+            fields["total_amount"] = amount + 0.0  # no negative zero
+            fields["total_amount_currency"] = total[1] or "USD"
+    vat = unique_match("total_vat_tax", text)
+    if vat:
+        amount = parse_amount(vat[0] or vat[2][:1], vat[2].lstrip("-"))
+        if amount == 0 or credit_note == (amount < 0):
+            fields["total_vat_tax_amount"] = amount + 0.0
+            fields["total_vat_tax_currency"] = vat[1]
+    return fields
+
+
+# compare a fast path value with the LLM value (case/trim-insensitive strings, float tolerance)
+def same_value(value, other):
+    if isinstance(value, str) and isinstance(other, str):
+        return value.strip().lower() == other.strip().lower()
+    if isinstance(value, float) and isinstance(other, float):
+        return abs(value - other) < 0.0001
+    return value == other
+
+
+# rule-based pre-extraction of the structurally fixed fields:
+#   check - the LLM extracts all fields, the fast path values are compared with the LLM output
+#   on    - the LLM extracts only the fields not found by the fast path (the optional fields, such as the net charges,
+#           are never pre-extracted, so the LLM is always called)
+class FastPath:
+    def __init__(self, mode):
+        self.mode = mode
+        self.residual = 0
+        self.checked = collections.Counter()
+        self.mismatches = collections.Counter()
+
+    async def extract(self, document, chain, sem):
+        fields = pre_extract(document)
+        if self.mode == "check":
+            result = await chain.ainvoke(document, sem)
+            record = result.model_dump()
+            for name, value in fields.items():
+                self.checked[name] += 1
+                if not same_value(value, record[name]):
+                    self.mismatches[name] += 1
+            return result
+        missing = [name for name in AwsInvoiceCredit.model_fields if name not in fields]
+        self.residual += 1
+        result = await chain.residual(missing).ainvoke(document, sem)
+        return AwsInvoiceCredit(**{**result.model_dump(), **fields})
+
+    def summary(self):
+        if self.mode == "check":
+            checked = sum(self.checked.values())
+            mismatches = ", ".join(f"{name}: {count}" for name, count in self.mismatches.most_common())
+            return f"Fast path fields matching the LLM: {checked - sum(self.mismatches.values())}/{checked}" + (
+                f" (mismatches: {mismatches})" if mismatches else "")
+        return f"Fast path documents with residual fields: {self.residual}"
+
+
+# relative and absolute tolerance of the net charges + VAT = total amount check (rounding, exchange rates)
+AMOUNT_RELATIVE_TOLERANCE = 0.01
+AMOUNT_ABSOLUTE_TOLERANCE = 0.02
+
+
+# names of the consistency checks failed by an extracted record:
+#   credit_note_sign - credit notes have negative totals, invoices do not
+#   amounts          - net charges plus VAT is the total amount (VAT converted with the exchange rate if needed)
+#   date_format      - dates are in the "Month name Day, Year" format with no leading zeros
+#   address_company  - the billing address company is not the Amazon entity
+def check_consistency(record):
+    problems = []
+    credit_note = "credit" in record.document_type.lower()
+    if credit_note != (record.total_amount < 0) and record.total_amount != 0:
+        problems.append("credit_note_sign")
+
+    net = record.net_charges_usd if record.total_amount_currency == "USD" else \
+        record.net_charges_non_usd if record.net_charges_currency == record.total_amount_currency else None
+    vat = record.total_vat_tax_amount
+    if vat is not None and record.total_vat_tax_currency not in (None, record.total_amount_currency):
+        # VAT printed in the local currency of an invoice totalled in USD
+        vat = vat / record.exchange_rate if record.total_amount_currency == "USD" and record.exchange_rate else None
+    if net is not None and vat is not None and abs(net + vat - record.total_amount) > \
+            AMOUNT_ABSOLUTE_TOLERANCE + AMOUNT_RELATIVE_TOLERANCE * abs(record.total_amount):
+        problems.append("amounts")
+
+    dates = [record.invoice_date, record.original_invoice_date, *record.billing_period.split(" - ")]
+    if any(date is not None and normalize_date(date) != date for date in dates) or " - " not in record.billing_period:
+        problems.append("date_format")
+
+    company = record.address_company.strip().lower()
+    if company == record.amazon_company_name.strip().lower() or \
+            FAST_PATH_PATTERNS["amazon_company_name"].search(record.address_company):
+        problems.append("address_company")
+    return problems
+
+
+# two-tier extraction: a cheaper model extracts every document first (through the fast path if enabled) and only
+# the documents whose result fails the consistency checks, or that it fails to extract, are sent to the strong model
+class ModelCascade:
+    def __init__(self, chain, first_model, strong_model):
+        # chain of the strong model
+        self.chain = chain
+        self.models = {"first": first_model, "strong": strong_model}
+        self.documents = collections.Counter()
+        self.latencies = {"first": [], "strong": []}
+        self.failed_checks = collections.Counter()
+
+    # extract the document with the first tier (by calling extract) and escalate it to the strong model if needed
+    async def extract(self, document, extract, sem):
+        start = time.monotonic()
+        try:
+            result = await extract()
+            problems = check_consistency(result)
+        except Exception as e:
+            problems = [type(e).__name__]
+        self.documents["first"] += 1
+        self.latencies["first"].append(time.monotonic() - start)
+        if not problems:
+            self.documents["accepted"] += 1
+            return result
+        self.failed_checks.update(problems)
+        start = time.monotonic()
+        try:
+            return await self.chain.ainvoke(document, sem)
+        finally:
+            self.documents["strong"] += 1
+            self.latencies["strong"].append(time.monotonic() - start)
+
+    def summary(self):
+        tiers = []
+        for tier, model in self.models.items():
+            values = sorted(self.latencies[tier])
+            latency = "/".join(f"{percentile(values, share):.2f}" for share in QUANTILES)
+            tiers.append(f"{tier} ({model}) {self.documents[tier]} documents, latency p50/p95/p99 {latency} s")
+        checks = ", ".join(f"{name}: {count}" for name, count in self.failed_checks.most_common()) or "none"
+        return (f"Cascade: {'; '.join(tiers)}; accepted from the first tier: {self.documents['accepted']}\n"
+                f"Cascade failed checks: {checks}\n"
+                f"Strong model: {self.chain.summary()}")
+
+
+# extract data from the document, using the cache if provided
+async def extract_data(model, document, sem, cache=None, chain=None, fast_path=None, cascade=None):
+    if cache is not None:
+        return await cache.get_or_extract(document,
+                                          lambda: extract_data(model, document, sem, chain=chain, fast_path=fast_path,
+                                                               cascade=cascade))
+    # Get the file name from the first line of the document
+    file_name = document.split("\n")[0].split(":")[1].strip()
+    try:
+        # Build the prompt and the parser unless they are shared by the caller
+        if chain is None:
+            chain = ExtractionChain(model)
+
+        def extract():
+            if fast_path is not None:
+                return fast_path.extract(document, chain, sem)
+            return chain.ainvoke(document, sem)
+
+        if cascade is not None:
+            return await cascade.extract(document, extract, sem)
+        return await extract()
+    except Exception as e:
+        span = CURRENT_SPAN.get()
+        if span is not None:
+            span.error = type(e).__name__
+        # returning and not raising the exception to continue processing other documents
+        return Exception(f"Error processing document {file_name}: {e}")
+
+
+# seconds an idle connection of the OpenAI client is kept open, so a long-running (--watch) process reuses warm
+# connections between invoices arriving minutes apart
+KEEPALIVE_EXPIRY = 300
+
+
+# instantiate the chat model for the selected service; the client keeps a pool of up to pool_size connections
+def create_llm(service, model, kwargs, max_retries=2, base_url=None, pool_size=100):
+    if service == "openai":
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size,
+                              keepalive_expiry=KEEPALIVE_EXPIRY)
+        return ChatOpenAI(
+            model=model,
+            openai_api_key=os.getenv("OPENAI_API_KEY"),
+            openai_api_base=base_url,
+            max_retries=max_retries,
+            http_async_client=httpx.AsyncClient(limits=limits),
+            temperature=kwargs.get("temperature", 0.0),  # default temperature is 0.0
+            max_tokens=kwargs.get("max_tokens", 4096),  # default max tokens is 4096
+            top_p=kwargs.get("top_p", 0.0),  # default top p is 0.0
+        )
+    elif service == "bedrock":
+        # boto3 (and botocore) are required by BedrockChat; the client keeps up to pool_size connections open so
+        # the requests running in the threads of the default executor do not wait for a connection
+        from botocore.config import Config
+        config = Config(max_pool_connections=pool_size, tcp_keepalive=True,
+                        retries={"total_max_attempts": max_retries + 1, "mode": "standard"})
+        return BedrockChat(
+            credentials_profile_name=os.getenv("AWS_PROFILE"),
+            model_id=model,
+            model_kwargs=kwargs,
+            endpoint_url=base_url,
+            config=config,
+        )
+    raise ValueError("Invalid service. Choose either 'openai' or 'bedrock'.")
+
+
+# read the CSV header from the output file or build it from the AwsInvoiceCredit model
+def read_header(output):
+    # Check if the file exists
+    if os.path.isfile(output):
+        # If the file exists, read the header
+        with open(output, 'r', newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            return next(reader)  # Read the header row
+    # If the file does not exist, create a new header based on the fields of the AwsInvoiceCredit model
+    return [field for field in AwsInvoiceCredit.__annotations__.keys()]
+
+
+# output CSV file opened for appending, the header is written if the file is empty
+class CsvOutput:
+    def __init__(self, output, header):
+        self.file = open(output, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=header)
+        if self.file.tell() == 0:
+            self.writer.writeheader()
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    # make the written rows durable before they are recorded in the journal
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # run the callback (recording the written rows in the journal) once the rows are durable
+    def commit(self, callback):
+        self.sync()
+        callback()
+
+    def close(self):
+        self.file.close()
+
+
+# Arrow schema of the model, derived from the field annotations (Optional fields are nullable)
+def arrow_schema(model=AwsInvoiceCredit):
+    import pyarrow as pa
+    types = {str: pa.string(), float: pa.float64(), int: pa.int64(), bool: pa.bool_()}
+    fields = []
+    for name, field in model.model_fields.items():
+        annotation, nullable = field.annotation, False
+        if get_origin(annotation) is Union:
+            annotation, nullable = [arg for arg in get_args(annotation) if arg is not type(None)][0], True
+        fields.append(pa.field(name, types[annotation], nullable=nullable))
+    return pa.schema(fields)
+
+
+# output Parquet dataset (a directory of Parquet files, pyarrow is required): records are buffered and written as
+# a new file of one row group every row_group_size records or flush_interval seconds, so every file in the directory
+# is complete and resumed runs append new files
+class ParquetOutput:
+    def __init__(self, output, row_group_size=1000, flush_interval=60):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa, self.pq = pa, pq
+        self.output = output
+        self.schema = arrow_schema()
+        self.row_group_size = row_group_size
+        self.flush_interval = flush_interval
+        os.makedirs(output, exist_ok=True)
+        # remove files of a crashed run that were not completely written
+        for name in os.listdir(output):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(output, name))
+        # unique per writer, so resumed runs and other processes never overwrite existing files
+        self.prefix = f"part-{datetime.now():%Y%m%d-%H%M%S-%f}-{uuid.uuid4().hex[:8]}"
+        self.files = 0
+        self.rows = []
+        # journal callbacks of the buffered rows
+        self.callbacks = []
+        self.flushed = time.monotonic()
+
+    def writerow(self, row):
+        self.rows.append({name: row.get(name) for name in self.schema.names})
+        if len(self.rows) >= self.row_group_size or time.monotonic() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    # the buffered rows are recorded in the journal once they are written (called after writerow, the row is already
+    # written if the buffer is empty)
+    def commit(self, callback):
+        if self.rows:
+            self.callbacks.append(callback)
+        else:
+            callback()
+
+    def flush(self):
+        self.flushed = time.monotonic()
+        if not self.rows:
+            return
+        table = self.pa.Table.from_pylist(self.rows, schema=self.schema)
+        path = os.path.join(self.output, f"{self.prefix}-{self.files:05d}.parquet")
+        self.pq.write_table(table, path + ".tmp")
+        with open(path + ".tmp", "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self.files += 1
+        self.rows = []
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def close(self):
+        self.flush()
+
+
+# open the output file (CSV) or dataset directory (Parquet) for appending
+@contextlib.contextmanager
+def open_output(output, header, output_format="csv", row_group_size=1000):
+    if output_format == "parquet":
+        writer = ParquetOutput(output, row_group_size)
+    else:
+        writer = CsvOutput(output, header)
+    try:
+        yield writer
+    finally:
+        writer.close()
+
+
+# write a single extraction result to the output; returns True if a record was written
+def write_result(writer, header, result):
+    if isinstance(result, Exception):
+        print(result)
+        return False
+    try:
+        record = result.model_dump()
+        # Fill missing keys with None or you can use an empty string ''
+        row = {key: record.get(key, None) for key in header}
+        writer.writerow(row)
+        print(f"Added record for: {record['file_name']}")
+        return True
+    except Exception as e:
+        print(f"Error saving record: {e}")
+        return False
+
+
+# write the result of the document at path and record it in the journal, if provided
+def save_result(writer, header, path, result, journal=None):
+    written = write_result(writer, header, result)
+    if journal is not None:
+        if written:
+            writer.commit(lambda: journal.record(path, "done"))
+        else:
+            journal.record(path, "failed", str(result))
+    return written
+
+
+# maximum number of requests in a single batch of the OpenAI Batch API
+BATCH_MAX_REQUESTS = 50000
+# final states of a batch
+BATCH_DONE_STATUSES = ["completed", "failed", "expired", "cancelled"]
+
+
+# body of a chat completion request, with the same model parameters as create_llm
+def chat_completion_body(model, kwargs, prompt):
+    return {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": kwargs.get("temperature", 0.0),
+        "max_tokens": kwargs.get("max_tokens", 4096),
+        "top_p": kwargs.get("top_p", 0.0),
+    }
+
+
+# offline extraction with the OpenAI Batch API: rendered prompts are written to JSONL files and submitted as batches,
+# results are collected into the output file once the batches are done; the submitted batches are tracked in a state
+# file next to the output, so submit, status and collect can run in separate processes
+class BatchJob:
+    def __init__(self, client, chain, output, model, kwargs, root=".", journal=None):
+        self.client = client
+        # requests are identified by the document path relative to the data folder
+        self.root = root
+        self.journal = journal
+        self.chain = chain
+        self.output = output
+        self.model = model
+        self.kwargs = kwargs
+        self.state_file = f"{output}.batch.json"
+        self.state = {"batches": []}
+        if os.path.isfile(self.state_file):
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+
+    def save(self):
+        with open(self.state_file + ".tmp", "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+    # write the (path, document) pairs (except those in batches not collected yet) to JSONL files and submit them
+    async def submit(self, documents):
+        pending = {custom_id for batch in self.state["batches"] if not batch["collected"] for custom_id in batch["custom_ids"]}
+        batch_file, custom_ids = None, []
+        for path, document in documents:
+            custom_id = relative_path(path, self.root)
+            if custom_id in pending:
+                continue
+            if batch_file is None:
+                batch_file = open(f"{self.output}.batch-{len(self.state['batches'])}.jsonl", "w")
+            request = {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                       "body": chat_completion_body(self.model, self.kwargs, self.chain.render(document))}
+            batch_file.write(json.dumps(request) + "\n")
+            custom_ids.append(custom_id)
+            if len(custom_ids) >= BATCH_MAX_REQUESTS:
+                await self.create_batch(batch_file, custom_ids)
+                batch_file, custom_ids = None, []
+        if batch_file is not None:
+            await self.create_batch(batch_file, custom_ids)
+
+    async def create_batch(self, batch_file, custom_ids):
+        batch_file.close()
+        with open(batch_file.name, "rb") as f:
+            input_file = await self.client.files.create(file=f, purpose="batch")
+        batch = await self.client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                                 completion_window="24h")
+        self.state["batches"].append({"id": batch.id, "input_file": batch_file.name, "status": batch.status,
+                                      "custom_ids": custom_ids, "collected": False})
+        self.save()
+        print(f"Submitted batch {batch.id} with {len(custom_ids)} documents")
+
+    # refresh and print the status of the batches not collected yet; returns True if all of them are done
+    async def status(self):
+        done = True
+        for batch in self.state["batches"]:
+            if batch["collected"]:
+                continue
+            remote = await self.client.batches.retrieve(batch["id"])
+            batch["status"] = remote.status
+            batch["output_file_id"] = remote.output_file_id
+            batch["error_file_id"] = remote.error_file_id
+            counts = remote.request_counts
+            print(f"Batch {batch['id']}: {remote.status}" +
+                  (f" ({counts.completed}/{counts.total} completed, {counts.failed} failed)" if counts else ""))
+            done = done and remote.status in BATCH_DONE_STATUSES
+        self.save()
+        return done
+
+    # write the results of the finished batches to the output file
+    async def collect(self, writer, header):
+        records = 0
+        for batch in self.state["batches"]:
+            if batch["collected"] or batch["status"] not in BATCH_DONE_STATUSES:
+                continue
+            for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+                if not file_id:
+                    continue
+                content = await self.client.files.content(file_id)
+                for line in content.text.splitlines():
+                    if not line.strip():
+                        continue
+                    line = json.loads(line)
+                    path = os.path.join(self.root, line["custom_id"])
+                    if save_result(writer, header, path, self.parse_result(line), self.journal):
+                        records += 1
+            batch["collected"] = True
+            self.save()
+        return records
+
+    # parse a line of a batch output or error file into AwsInvoiceCredit (or an Exception)
+    def parse_result(self, line):
+        response = line.get("response") or {}
+        try:
+            if line.get("error") or response.get("status_code") != 200:
+                raise ValueError(line.get("error") or response.get("body"))
+            body = response["body"]
+            self.chain.documents += 1
+            self.chain.prompt_tokens += body.get("usage", {}).get("prompt_tokens", 0)
+            self.chain.completion_tokens += body.get("usage", {}).get("completion_tokens", 0)
+            return self.chain.parser.parse(body["choices"][0]["message"]["content"])
+        except Exception as e:
+            return Exception(f"Error processing document {line.get('custom_id')}: {e}")
+
+    # submit, wait for the batches to finish and collect the results
+    async def run(self, documents, writer, header, poll_interval=60):
+        await self.submit(documents)
+        while not await self.status():
+            await asyncio.sleep(poll_interval)
+        return await self.collect(writer, header)
+
+
+# value below which the given share of the sorted values falls (nearest rank)
+def percentile(values, share):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(share * len(values)) - 1))]
+
+
+# quantiles of the latency summary and the Prometheus metrics
+QUANTILES = [0.5, 0.95, 0.99]
+# minimum number of seconds between two updates of the Prometheus textfile during the run
+METRICS_INTERVAL = 15
+
+
+# per-document spans of the extraction: written as JSON lines to the trace file and aggregated into latency
+# percentiles, throughput, token usage and an error histogram (run summary and Prometheus textfile)
+class Telemetry:
+    def __init__(self, trace_file=None, metrics_file=None):
+        self.trace = open(trace_file, "a") if trace_file else None
+        self.metrics_file = metrics_file
+        # spans of the parsed documents waiting for extraction, by path
+        self.spans = {}
+        self.start = time.monotonic()
+        self.end = None
+        self.metrics_written = self.start
+        self.latencies = {"parse": [], "queue_wait": [], "llm": [], "document": []}
+        self.statuses = collections.Counter()
+        self.errors = collections.Counter()
+        self.failures = collections.Counter()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+
+    # start the span of a parsed document (called from the scan thread)
+    def parsed(self, path, parse_time, raw_tokens=None, text_tokens=None):
+        self.spans[path] = DocumentSpan(path, parse_time, raw_tokens, text_tokens)
+
+    # extract data from the document (by calling extract) within its span
+    async def extract(self, path, extract, document):
+        span = self.spans.pop(path, None) or DocumentSpan(path)
+        span.started = time.monotonic()
+        span.queue_wait += span.started - span.ready
+        token = CURRENT_SPAN.set(span)
+        try:
+            result = await extract(document)
+        finally:
+            CURRENT_SPAN.reset(token)
+        self.finish(span, result)
+        return result
+
+    def finish(self, span, result):
+        self.end = time.monotonic()
+        span.duration = self.end - span.started
+        span.status = "failed" if isinstance(result, Exception) else "done"
+        self.statuses[span.status] += 1
+        self.latencies["parse"].append(span.parse_time)
+        self.latencies["queue_wait"].append(span.queue_wait)
+        if span.requests:
+            self.latencies["llm"].append(span.llm_latency)
+        self.latencies["document"].append(span.duration)
+        self.errors.update(span.errors)
+        if span.error:
+            self.failures[span.error] += 1
+        self.prompt_tokens += span.prompt_tokens
+        self.completion_tokens += span.completion_tokens
+        self.retries += span.retries
+        if self.trace is not None:
+            self.trace.write(json.dumps(span.to_dict()) + "\n")
+        if self.metrics_file and self.end - self.metrics_written >= METRICS_INTERVAL:
+            self.write_metrics()
+
+    def documents_per_second(self):
+        elapsed = (self.end or time.monotonic()) - self.start
+        return sum(self.statuses.values()) / elapsed if elapsed > 0 else 0.0
+
+    def quantiles(self, stage):
+        values = sorted(self.latencies[stage])
+        return [percentile(values, share) for share in QUANTILES]
+
+    # write the metrics in the Prometheus text format (atomically, for the node exporter textfile collector)
+    def write_metrics(self):
+        lines = ["# HELP invoice_extraction_documents_total Documents extracted, by status.",
+                 "# TYPE invoice_extraction_documents_total counter"]
+        lines += [f'invoice_extraction_documents_total{{status="{status}"}} {self.statuses[status]}'
+                  for status in ("done", "failed")]
+        lines += ["# HELP invoice_extraction_seconds Time per document spent in each stage.",
+                  "# TYPE invoice_extraction_seconds summary"]
+        for stage, values in self.latencies.items():
+            lines += [f'invoice_extraction_seconds{{stage="{stage}",quantile="{share}"}} {value}'
+                      for share, value in zip(QUANTILES, self.quantiles(stage))]
+            lines += [f'invoice_extraction_seconds_sum{{stage="{stage}"}} {sum(values)}',
+                      f'invoice_extraction_seconds_count{{stage="{stage}"}} {len(values)}']
+        lines += ["# HELP invoice_extraction_tokens_total LLM tokens used, by type.",
+                  "# TYPE invoice_extraction_tokens_total counter",
+                  f'invoice_extraction_tokens_total{{type="prompt"}} {self.prompt_tokens}',
+                  f'invoice_extraction_tokens_total{{type="completion"}} {self.completion_tokens}',
+                  "# HELP invoice_extraction_retries_total Retried LLM requests.",
+                  "# TYPE invoice_extraction_retries_total counter",
+                  f"invoice_extraction_retries_total {self.retries}",
+                  "# HELP invoice_extraction_errors_total Failed LLM requests and response parsing attempts, by error type.",
+                  "# TYPE invoice_extraction_errors_total counter"]
+        lines += [f'invoice_extraction_errors_total{{error="{error}"}} {count}' for error, count in self.errors.items()]
+        lines += ["# HELP invoice_extraction_documents_per_second Documents extracted per second since the start of the run.",
+                  "# TYPE invoice_extraction_documents_per_second gauge",
+                  f"invoice_extraction_documents_per_second {self.documents_per_second()}"]
+        with open(self.metrics_file + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(self.metrics_file + ".tmp", self.metrics_file)
+        self.metrics_written = time.monotonic()
+
+    def summary(self):
+        documents = sum(self.statuses.values())
+        tokens = (self.prompt_tokens + self.completion_tokens) / documents if documents else 0.0
+        latencies = ", ".join(f"{stage} " + "/".join(f"{value:.2f}" for value in self.quantiles(stage))
+                              for stage in self.latencies)
+        errors = ", ".join(f"{error}: {count}" for error, count in self.errors.most_common()) or "none"
+        failures = ", ".join(f"{error}: {count}" for error, count in self.failures.most_common()) or "none"
+        return (f"Documents extracted: {documents} ({self.statuses['failed']} failed), "
+                f"{self.documents_per_second():.2f} documents/sec, {tokens:.0f} tokens/document\n"
+                f"Latency p50/p95/p99 (seconds): {latencies}\n"
+                f"Errors: {errors}; failed documents by error: {failures}")
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+        if self.metrics_file:
+            self.write_metrics()
+
+
+# read all records of an output file (CSV) or dataset directory (Parquet)
+def read_records(output):
+    if os.path.isdir(output):
+        import pyarrow.parquet as pq
+        return pq.read_table(output).to_pylist()
+    with open(output, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+# merge the shard outputs of the output into it in the AwsInvoiceCredit column order, dropping duplicate records
+# (same file name and payer id), and report the documents of each shard that are not done according to its journal
+def merge_shards(output, data_dir, output_format="csv"):
+    base, ext = os.path.splitext(output)
+    pattern = re.compile(re.escape(os.path.basename(base)) + r"\.shard-(\d+)-of-(\d+)" + re.escape(ext))
+    outputs, counts = {}, set()
+    for name in os.listdir(os.path.dirname(output) or "."):
+        match = pattern.fullmatch(name)
+        if match:
+            outputs[int(match.group(1))] = os.path.join(os.path.dirname(output), name)
+            counts.add(int(match.group(2)))
+    if len(counts) != 1:
+        raise ValueError(f"Expected shard outputs of a single shard count for {output}, found: {sorted(counts)}")
+    shards = counts.pop()
+
+    # documents of each shard in the data folder
+    expected = collections.defaultdict(set)
+    for path in iter_pdf_files(data_dir):
+        document = relative_path(path, data_dir)
+        expected[shard_of(document, shards)].add(document)
+    incomplete = []
+    for shard in range(1, shards + 1):
+        journal_file = f"{shard_output(output, shard, shards)}.journal"
+        if shard not in outputs or not os.path.isfile(journal_file):
+            print(f"Shard {shard}/{shards}: no output or journal, {len(expected[shard])} documents missing")
+            incomplete.append(shard)
+            continue
+        journal = ProcessingJournal(journal_file, data_dir)
+        journal.close()
+        missing = sorted(document for document in expected[shard]
+                         if journal.entries.get(document, {}).get("status") != "done")
+        failed = sum(journal.entries.get(document, {}).get("status") == "failed" for document in missing)
+        print(f"Shard {shard}/{shards}: {len(expected[shard]) - len(missing)}/{len(expected[shard])} documents done" +
+              (f", {len(missing)} missing ({failed} failed), e.g. {', '.join(missing[:3])}" if missing else ""))
+        if missing:
+            incomplete.append(shard)
+
+    # write the merged records to a temporary file (or dataset) replacing the output once complete
+    header = list(AwsInvoiceCredit.model_fields)
+    merged = f"{output}.tmp"
+    if os.path.isdir(merged):
+        shutil.rmtree(merged)
+    elif os.path.exists(merged):
+        os.remove(merged)
+    seen = set()
+    duplicates = 0
+    with open_output(merged, header, output_format) as writer:
+        for shard in sorted(outputs):
+            for record in read_records(outputs[shard]):
+                key = (record.get("file_name"), record.get("doit_payer_id"))
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+                writer.writerow({name: record.get(name) for name in header})
+    if os.path.isdir(output):
+        shutil.rmtree(output)
+    elif os.path.exists(output):
+        os.remove(output)
+    os.replace(merged, output)
+    print(f"Merged {len(seen)} records of {len(outputs)} shards into {output} ({duplicates} duplicates dropped)")
+    return {"records": len(seen), "duplicates": duplicates, "incomplete": incomplete}
+
+
+# print the run summary of all enabled pipeline components
+def print_summary(*components):
+    for component in components:
+        if component is not None:
+            print(component.summary())
+
+
+# end of a run, also when it fails: print the summary of the components, close the resources (None is skipped) and
+# print the time elapsed since start
+@contextlib.contextmanager
+def finishing(start, components=(), resources=()):
+    try:
+        yield
+    finally:
+        print_summary(*components)
+        for resource in resources:
+            if resource is not None:
+                resource.close()
+        print(f"Time elapsed: {time.time() - start} seconds")
+
+
+# streaming pipeline: parse documents (path, document pairs) in a background thread (producer), feed them into
+# a bounded queue and let a fixed pool of async workers extract data and write the results as soon as they are available;
+# the extraction of each document is recorded in its span, if telemetry is provided
+async def run_pipeline(extract, documents, writer, header, workers, queue_size=0, journal=None, telemetry=None):
+    queue = asyncio.Queue(maxsize=queue_size or 2 * workers)
+    loop = asyncio.get_running_loop()
+    start = time.time()
+    stats = {"documents": 0, "records": 0, "first_record": None}
+
+    # parse documents one by one outside the event loop so the workers keep running
+    async def produce():
+        iterator = iter(documents)
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="scan") as executor:
+            try:
+                while True:
+                    doc = await loop.run_in_executor(executor, next, iterator, None)
+                    if doc is None:
+                        break
+                    stats["documents"] += 1
+                    await queue.put(doc)
+            finally:
+                # signal every worker to stop once the queue is drained
+                for _ in range(workers):
+                    await queue.put(None)
+
+    async def consume():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            path, doc = item
+            result = await (telemetry.extract(path, extract, doc) if telemetry is not None else extract(doc))
+            if save_result(writer, header, path, result, journal):
+                stats["records"] += 1
+                if stats["first_record"] is None:
+                    stats["first_record"] = time.time() - start
+                    print(f"Time to first record: {stats['first_record']} seconds")
+
+    await asyncio.gather(produce(), *[consume() for _ in range(workers)])
+    return stats
+
+
+# write the rows buffered by a Parquet output of a long-running process at least every flush interval, also when no
+# new record arrives, until stop is set
+async def flush_periodically(writer, stop):
+    while not stop.is_set():
+        await asyncio.sleep(1)
+        if isinstance(writer, ParquetOutput) and time.monotonic() - writer.flushed >= writer.flush_interval:
+            writer.flush()
 
 
 async def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--concurrency", type=int, help="number of concurrent requests to make", default=50,
+    parser.add_argument("--concurrency", type=int, help="maximum number of concurrent requests to make", default=50,
+                        required=False)
+    parser.add_argument("--tpm", type=int, help="tokens per minute quota of the account (0 for unlimited)", default=0,
+                        required=False)
+    parser.add_argument("--rpm", type=int, help="requests per minute quota of the account (0 for unlimited)", default=0,
                         required=False)
+    parser.add_argument("--max_retries", type=int, help="maximum number of retries of a throttled or failed request",
+                        default=5, required=False)
     parser.add_argument("--max_docs", type=int, help="maximum number of documents to process", default=0,
                         required=False)
     parser.add_argument("--data_dir", type=str, help="folder to scan for documents", default="./data")
     parser.add_argument("--model", type=str, help="model name", default="gpt-4o", required=False)
-    parser.add_argument("--output", type=str, help="output file name", default="invoices.csv", required=False)
+    parser.add_argument("--cascade_model", type=str, required=False,
+                        help="cheaper model extracting every document first; only documents whose result fails the "
+                             "consistency checks (credit note sign, net charges + VAT = total, date format, billing "
+                             "company) are sent again to --model")
+    parser.add_argument("--output", type=str, help="output file name, dataset directory for Parquet (default: "
+                                                   "invoices.csv or invoices.parquet)", required=False)
+    parser.add_argument("--format", type=str, choices=["csv", "parquet"], default="csv", required=False,
+                        help="output format: CSV file or typed Parquet dataset (requires pyarrow)")
+    parser.add_argument("--row_group_size", type=int, help="number of records buffered per Parquet file",
+                        default=1000, required=False)
     parser.add_argument("--service", type=str, help="service to use for LLM models (openai or bedrock)",
                         default="openai", required=False)
     # get kwargs from the command line
     parser.add_argument('--kwargs', type=str, help="additional arguments for the model (dict)", required=False)
+    parser.add_argument("--retry_failed", type=str, default="*", required=False,
+                        help="process again the failed documents whose path (relative to the data folder) matches this "
+                             "pattern; empty to skip all failed documents")
+    parser.add_argument("--base_url", type=str, help="base URL of the OpenAI compatible API or endpoint URL of the "
+                                                     "Bedrock runtime", required=False)
+    parser.add_argument("--pool_size", type=int, default=0, required=False,
+                        help="maximum number of connections kept open by the LLM client (default: concurrency)")
+    parser.add_argument("--bedrock_threads", type=int, default=0, required=False,
+                        help="number of threads running the blocking Bedrock requests (default: concurrency)")
+    parser.add_argument("--mode", type=str, choices=["live", "batch", "merge"], default="live", required=False,
+                        help="live requests, offline extraction with the OpenAI Batch API or merge of the shard outputs "
+                             "of --output into it")
+    parser.add_argument("--shard", type=str, required=False,
+                        help="process only shard K of N (K/N) of the documents, by a stable hash of their path relative "
+                             "to the data folder; the shard writes its own output with a .shard-K-of-N suffix")
+    parser.add_argument("--batch_action", type=str, choices=["run", "submit", "status", "collect"], default="run",
+                        required=False, help="batch mode: submit the documents, print the status of the submitted "
+                                             "batches, collect the results of finished batches or all of them (run)")
+    parser.add_argument("--poll_interval", type=int, help="seconds between batch status checks", default=60,
+                        required=False)
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and extract new PDF files as they arrive in the data folder (inotify, "
+                             "polling if not available) until SIGTERM or Ctrl+C; documents are parsed in the watcher "
+                             "thread, --parse_workers is ignored")
+    parser.add_argument("--watch_poll_interval", type=float, default=2.0, required=False,
+                        help="seconds between two checks of the data folder when inotify is not available")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream documents from the folder scan to a pool of workers instead of scanning everything first")
+    parser.add_argument("--queue_size", type=int, help="maximum number of parsed documents waiting for a worker in "
+                                                       "streaming mode (default: 2 x concurrency)", default=0, required=False)
+    parser.add_argument("--parse_workers", type=int, help="number of processes used to parse PDF files", default=1,
+                        required=False)
+    parser.add_argument("--max_pages", type=int, help="number of PDF pages to read until the footer is found "
+                                                      "(0 for all pages)", default=1, required=False)
+    parser.add_argument("--hedge_percentile", type=float, default=0, required=False,
+                        help="send a duplicate of a request still running after this percentile of the recent request "
+                             "latencies (e.g. 95) and keep the first valid result (0 to disable)")
+    parser.add_argument("--hedge_budget", type=float, default=0.05, required=False,
+                        help="maximum share of the requests sent again as hedges")
+    parser.add_argument("--preprocess", action="store_true",
+                        help="shrink the invoice text sent to the LLM: normalise whitespace, remove boilerplate lines "
+                             "and repeated page headers, collapse line items (keeping RI, total, VAT and exchange "
+                             "rate lines)")
+    parser.add_argument("--preprocess_rules", type=str, required=False,
+                        help="JSON file replacing the default preprocessing rules (remove, repeated, line_items_start, "
+                             "line_items_end, keep), implies --preprocess")
+    parser.add_argument("--docs_per_request", type=int, default=1, required=False,
+                        help="number of documents packed into a single LLM request (keep the completion within the "
+                             "model max_tokens, about 600 tokens per document)")
+    parser.add_argument("--fast_path", type=str, choices=["off", "check", "on"], default="off", required=False,
+                        help="pre-extract structurally fixed fields with regular expressions: 'check' compares them "
+                             "with the LLM output, 'on' asks the LLM only for the remaining fields")
+    parser.add_argument("--cache_dir", type=str, help="folder for the persistent extraction cache (disabled if not set)",
+                        required=False)
+    parser.add_argument("--cache_max_entries", type=int, help="maximum number of entries kept in the extraction cache "
+                                                              "(0 for unlimited)", default=0, required=False)
+    parser.add_argument("--cache_max_age_days", type=int, help="maximum age of extraction cache entries in days "
+                                                               "(0 for unlimited)", default=0, required=False)
+    parser.add_argument("--trace_file", type=str, help="JSONL file for the per-document spans (parse time, queue "
+                                                       "wait, LLM latency, tokens, retries, errors)", required=False)
+    parser.add_argument("--metrics_file", type=str, help="Prometheus textfile for the extraction metrics, updated "
+                                                         "during the run", required=False)
 
     args = parser.parse_args()
+    args.output = args.output or f"invoices.{args.format}"
     kwargs = json.loads(args.kwargs) if args.kwargs else {}
 
-    # Instantiate the semaphore to limit the number of concurrent requests.
-    # Approximate number of tokens per request is 1000-1500, so 50 requests will be 75k tokens
-    # a single request takes 10 seconds, so 30 concurrent requests can lead to 180 requests per minute
-    # 180 * 1500 = 270k tokens per minute (TPM) should be within the 600k TPM limit
-    sem = asyncio.Semaphore(args.concurrency)
+    if args.mode == "merge":
+        merge_shards(args.output, args.data_dir, args.format)
+        return
+    shard = parse_shard(args.shard) if args.shard else None
+    if shard is not None:
+        args.output = shard_output(args.output, *shard)
 
-    # Instantiate the model.
-    if args.service == "openai":
-        llm = ChatOpenAI(
-            model=args.model,
-            openai_api_key=os.getenv("OPENAI_API_KEY"),
-            temperature=kwargs.get("temperature", 0.0),  # default temperature is 0.0
-            max_tokens=kwargs.get("max_tokens", 4096),  # default max tokens is 4096
-            top_p=kwargs.get("top_p", 0.0),  # default top p is 0.0
-        )
-    elif args.service == "bedrock":
-        llm = BedrockChat(
-            credentials_profile_name=os.getenv("AWS_PROFILE"),
-            model_id=args.model,
-            model_kwargs=kwargs
-        )
-    else:
-        raise ValueError("Invalid service. Choose either 'openai' or 'bedrock'.")
+    # Instantiate the rate limiter to keep the requests within the account quota.
+    # Approximate number of tokens per request is 1000-1500 and a single request takes about 10 seconds, so the
+    # number of requests in flight is adapted between 1 and --concurrency from the observed throttling (and latency,
+    # with a budget), while the --tpm/--rpm budgets cap the rate at which new requests are sent.
+    limiter = RateLimiter(args.concurrency, args.tpm, args.rpm, args.max_retries)
+
+    # BedrockChat has no native async implementation: its requests run in the default executor of the event loop,
+    # which is sized for the requested concurrency instead of the min(32, cpu + 4) threads of the asyncio default
+    pool_size = args.pool_size or args.concurrency
+    if args.service == "bedrock":
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=args.bedrock_threads or args.concurrency, thread_name_prefix="bedrock"))
+
+    # Instantiate the model (retries are handled by the rate limiter).
+    llm = create_llm(args.service, args.model, kwargs, max_retries=0, base_url=args.base_url, pool_size=pool_size)
+    # Build the prompt and the parser once for all documents
+    chain = ExtractionChain(llm)
+
+    # With a cascade, the cheaper model extracts first and the model above handles the inconsistent results
+    cascade = None
+    if args.cascade_model:
+        cascade = ModelCascade(chain, args.cascade_model, args.model)
+        chain = ExtractionChain(create_llm(args.service, args.cascade_model, kwargs, max_retries=0,
+                                           base_url=args.base_url, pool_size=pool_size))
+
+    # Open the extraction cache, if enabled
+    cache = None
+    if args.cache_dir:
+        cache = ExtractionCache(args.cache_dir, extraction_fingerprint(args.service, args.model, kwargs, args.fast_path,
+                                                                       args.cascade_model),
+                                args.cache_max_entries, args.cache_max_age_days)
+    # Preprocess the parsed documents before the extraction (and the cache lookup)
+    preprocessor = None
+    if args.preprocess or args.preprocess_rules:
+        preprocessor = Preprocessor(load_preprocess_rules(args.preprocess_rules) if args.preprocess_rules else None)
+
+    # Hedge the straggling single-document requests
+    if args.hedge_percentile:
+        chain = RequestHedger(chain, args.hedge_percentile / 100, args.hedge_budget)
+    if args.docs_per_request > 1:
+        chain = RequestPacker(chain, args.docs_per_request)
+    fast_path = FastPath(args.fast_path) if args.fast_path != "off" else None
+    # Extract data from a single document (async)
+    extract = functools.partial(extract_data, llm, sem=limiter, cache=cache, chain=chain, fast_path=fast_path,
+                                cascade=cascade)
 
     # measure time
     start = time.time()
 
-    processed_files = []
-    if os.path.isfile(args.output):
-        processed_files = get_sorted_column_values(args.output, 0)
-        print(f"Found {len(processed_files)} processed documents")
+    # Resume from the processing journal; the documents of an output written without a journal are imported into it
+    repair_output(args.output)
+    journal = ProcessingJournal(f"{args.output}.journal", args.data_dir, args.retry_failed)
+    if journal.entries:
+        print(journal.summary())
+    elif args.format == "csv" and os.path.isfile(args.output) and os.path.getsize(args.output):
+        journal.import_output(args.output)
 
-    # Scan the folder for documents up to the max documents if specified
-    all_documents = scan_folder(args.data_dir, args.max_docs, processed_files)
-    print(f"Found {len(all_documents)} new documents")
-    end_scan = time.time()
-    print(f"Time elapsed: {end_scan - start} seconds")
+    # skip documents of other shards and documents that are done (or failed and not retried)
+    def skip(path):
+        if shard is not None and shard_of(relative_path(path, args.data_dir), shard[1]) != shard[0]:
+            return True
+        return journal.skip(path)
 
-    # Check if the file exists
-    if os.path.isfile(args.output):
-        # If the file exists, read the header
-        with open(args.output, 'r', newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            header = next(reader)  # Read the header row
-    else:
-        # If the file does not exist, create a new header based on the fields of the AwsInvoiceCredit model
-        header = [field for field in AwsInvoiceCredit.__annotations__.keys()]
-
-    # Loop over the all scanned documents
-    tasks = []
-    for i, doc in enumerate(all_documents):
-        # Extract data from the document (async)
-        tasks.append(extract_data(llm, doc, sem))
-
-    # Create a CSV file and write the results as they become available
-    with open(args.output, 'a', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=header)
-        # If the file is empty, write the header
-        if f.tell() == 0:
-            writer.writeheader()
-        # Write the results as they become available
-        for future in asyncio.as_completed(tasks):
-            result = await future
-            if isinstance(result, Exception):
-                print(result)
+    header = read_header(args.output)
+
+    if args.mode == "batch":
+        if args.service != "openai":
+            raise ValueError("Batch mode supports only the 'openai' service.")
+        client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=args.base_url)
+        job = BatchJob(client, ExtractionChain(llm), args.output, args.model, kwargs, args.data_dir, journal)
+        documents = iter_documents(args.data_dir, args.max_docs, skip, args.parse_workers, args.max_pages,
+                                   preprocessor=preprocessor)
+        with finishing(start, resources=(journal, cache)):
+            if args.batch_action == "submit":
+                await job.submit(documents)
+            elif args.batch_action == "status":
+                await job.status()
             else:
-                # Convert the result to a DataFrame and append it to the CSV file
+                with open_output(args.output, header, args.format, args.row_group_size) as writer:
+                    if args.batch_action == "collect":
+                        await job.status()
+                        records = await job.collect(writer, header)
+                    else:
+                        records = await job.run(documents, writer, header, args.poll_interval)
+                print(f"Added {records} records")
+                print_summary(preprocessor, job.chain, journal)
+        return
+
+    # Record per-document spans of the live extraction
+    telemetry = Telemetry(args.trace_file, args.metrics_file)
+    # Print the summary and close the journal, the telemetry and the cache at the end of the run
+    summary = finishing(start, (preprocessor, limiter, chain, fast_path, cascade, cache, journal, telemetry),
+                        (journal, telemetry, cache))
+
+    if args.watch:
+        # Extract the documents already in the folder, then the new ones as they arrive, with the same client
+        # and rate limiter for the whole run; SIGTERM stops the watcher and lets the workers finish
+        stop = threading.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        watcher = FolderWatcher(args.data_dir, args.watch_poll_interval)
+        print(f"Watching {args.data_dir} for new documents")
+        with summary, contextlib.closing(watcher), \
+                open_output(args.output, header, args.format, args.row_group_size) as writer:
+            documents = watch_documents(watcher, stop, args.max_docs, skip, args.max_pages, telemetry, preprocessor)
+
+            async def pipeline():
                 try:
-                    record = result.model_dump()
-                    # Fill missing keys with None or you can use an empty string ''
-                    row = {key: record.get(key, None) for key in header}
-                    writer.writerow(row)
-                    print(f"Added record for: {record['file_name']}")
-                except Exception as e:
-                    print(f"Error saving record: {e}")
+                    return await run_pipeline(extract, documents, writer, header, args.concurrency, args.queue_size,
+                                              journal, telemetry)
+                finally:
+                    stop.set()
+
+            stats, _ = await asyncio.gather(pipeline(), flush_periodically(writer, stop))
+            print(f"Stopped watching, processed {stats['documents']} new documents, added {stats['records']} records")
+        return
+
+    if args.stream:
+        # Parse and extract documents concurrently, writing the results as they become available
+        with summary:
+            with open_output(args.output, header, args.format, args.row_group_size) as writer:
+                documents = iter_documents(args.data_dir, args.max_docs, skip, args.parse_workers, args.max_pages,
+                                           telemetry, preprocessor)
+                stats = await run_pipeline(extract, documents, writer, header, args.concurrency, args.queue_size,
+                                           journal, telemetry)
+            print(f"Processed {stats['documents']} new documents, added {stats['records']} records")
+        return
+
+    with summary:
+        # Scan the folder for documents up to the max documents if specified
+        all_documents = list(iter_documents(args.data_dir, args.max_docs, skip, args.parse_workers, args.max_pages,
+                                            telemetry, preprocessor))
+        print(f"Found {len(all_documents)} new documents")
+        print(f"Time elapsed: {time.time() - start} seconds")
+
+        # Extract data from the document (async), keeping its path for the journal
+        async def extract_document(path, doc):
+            return path, await telemetry.extract(path, extract, doc)
+
+        # Loop over the all scanned documents
+        tasks = []
+        for path, doc in all_documents:
+            tasks.append(extract_document(path, doc))
+
+        # Create a CSV file and write the results as they become available
+        with open_output(args.output, header, args.format, args.row_group_size) as writer:
+            # Write the results as they become available
+            for future in asyncio.as_completed(tasks):
+                path, result = await future
+                save_result(writer, header, path, result, journal)
 
-    # measure time
-    end = time.time()
-    print(f"Time elapsed: {end - end_scan} seconds")
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,23 +1,91 @@
 import argparse
+import collections
 import csv
+import errno
+import fcntl
 import os
-import re
 import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
+# ioctl request cloning a file on copy-on-write filesystems (Btrfs, XFS): linux/fs.h FICLONE
+FICLONE = 0x40049409
 
-def copy_files(csv_file='invoices-test.csv', source_dir=None, target_dir='data/test-invoices'):
-    if source_dir is None:
-        print("Please provide a source directory.")
-        sys.exit(1)
 
-    if os.path.exists(target_dir):
-        if os.listdir(target_dir):  # directory is not empty
-            print("Target directory is not empty. Please delete the target directory and try again.")
-            sys.exit(1)
-    else:
-        os.makedirs(target_dir)  # create target directory if it doesn't exist
+# index of the source directory, built with one listing of the payer folders; the files of a folder are listed the
+# first time one of them is looked up
+class SourceIndex:
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        self.folders = set()
+        # payer id -> folders named <aws account number>_<payer id>
+        self.payer_folders = collections.defaultdict(list)
+        with os.scandir(source_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    self.folders.add(entry.name)
+                    if "_" in entry.name:
+                        self.payer_folders[entry.name.split("_", 1)[1]].append(entry.name)
+        self.files = {}
+
+    def folder_files(self, folder):
+        if folder not in self.files:
+            with os.scandir(os.path.join(self.source_dir, folder)) as entries:
+                self.files[folder] = {entry.name for entry in entries if entry.is_file()}
+        return self.files[folder]
+
+    # path of the file in the payer folder; sometimes the folder name is based on a different aws_account_number but
+    # the same doit_payer_id, the file is then taken from the only folder of the payer
+    def find(self, subfolder, file_name, doit_payer_id):
+        folders = [subfolder] if subfolder in self.folders else []
+        if not folders and len(self.payer_folders[doit_payer_id]) == 1:
+            folders = self.payer_folders[doit_payer_id]
+        for folder in folders:
+            if file_name in self.folder_files(folder):
+                return os.path.join(self.source_dir, folder, file_name)
+        return None
+
 
+# clone the file (copy-on-write, no data is duplicated), falls back to a copy if the filesystem does not support it
+def reflink(source_file_path, target_file_path):
+    with open(source_file_path, "rb") as source, open(target_file_path, "wb") as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            return "reflink"
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                raise
+    shutil.copy(source_file_path, target_file_path)
+    return "copy"
+
+
+# copy or link the source file to the target file path; hard links across filesystems and symbolic links on
+# filesystems (or platforms) without them fall back to a copy
+def place_file(source_file_path, target_file_path, link=None):
+    if link == "hard":
+        try:
+            os.link(source_file_path, target_file_path)
+            return "hard"
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    elif link == "symlink":
+        try:
+            os.symlink(os.path.abspath(source_file_path), target_file_path)
+            return "symlink"
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.ENOSYS):
+                raise
+    elif link == "reflink":
+        return reflink(source_file_path, target_file_path)
+    shutil.copy(source_file_path, target_file_path)
+    return "copy"
+
+
+# plan the files to copy: (source file path or None if not found, target file path) for every file of the CSV file
+def plan_copies(csv_file, source_dir, target_dir):
+    index = SourceIndex(source_dir)
+    plan = {}
     with open(csv_file, 'r') as file:
         reader = csv.reader(file)
         next(reader)  # skip header row
@@ -26,26 +94,61 @@ def copy_files(csv_file='invoices-test.csv', source_dir=None, target_dir='data/t
             aws_account_number = row[3]
             doit_payer_id = row[1]
             subfolder = f"{aws_account_number}_{doit_payer_id}"
-            source_file_path = os.path.join(source_dir, subfolder, file_name)
-            target_path = os.path.join(target_dir, subfolder)
-            os.makedirs(target_path, exist_ok=True)
-            # sometimes the subfolder name is based on different aws_account_number but the same doit_payer_id
-            if not os.path.exists(source_file_path):
-                # find all subfolder in source_dir ending with doit_payer_id
-                subfolders = [f for f in os.listdir(source_dir) if re.search(f"_{doit_payer_id}$", f)]
-                # if there is only one subfolder, use that as source
-                if len(subfolders) == 1:
-                    source_file_path = os.path.join(source_dir, subfolders[0], file_name)
-            if os.path.exists(source_file_path):
-                try:
-                    shutil.copy(source_file_path, target_path)
-                    print(f"Copying file from {source_file_path} to {target_path}")
-                except IOError as e:
-                    print(f"Unable to copy file. {os.strerror(e.errno)}")
-                except:
-                    print("Unexpected error:", sys.exc_info())
-            else:
-                print(f"Source file {source_file_path} does not exist.")
+            target_file_path = os.path.join(target_dir, subfolder, file_name)
+            if target_file_path not in plan:
+                plan[target_file_path] = index.find(subfolder, file_name, doit_payer_id)
+    return [(source_file_path, target_file_path) for target_file_path, source_file_path in plan.items()]
+
+
+def copy_files(csv_file='invoices-test.csv', source_dir=None, target_dir='data/test-invoices', link=None, workers=16,
+               dry_run=False, manifest=None):
+    if source_dir is None:
+        print("Please provide a source directory.")
+        sys.exit(1)
+
+    if not dry_run:
+        if os.path.exists(target_dir):
+            if os.listdir(target_dir):  # directory is not empty
+                print("Target directory is not empty. Please delete the target directory and try again.")
+                sys.exit(1)
+        else:
+            os.makedirs(target_dir)  # create target directory if it doesn't exist
+
+    plan = plan_copies(csv_file, source_dir, target_dir)
+    for source_file_path, target_file_path in plan:
+        if source_file_path is None:
+            print(f"Source file for {target_file_path} does not exist.")
+
+    # write the planned copies to the manifest (action: the link mode, or missing if the source file was not found)
+    if manifest:
+        with open(manifest, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["source", "target", "action"])
+            for source_file_path, target_file_path in plan:
+                writer.writerow([source_file_path or "", target_file_path,
+                                 "missing" if source_file_path is None else link or "copy"])
+    found = [(source, target) for source, target in plan if source is not None]
+    if dry_run:
+        print(f"Dry run: {len(found)} files to {link or 'copy'}, {len(plan) - len(found)} missing")
+        return collections.Counter({"missing": len(plan) - len(found)})
+
+    for target_path in {os.path.dirname(target) for _, target in found}:
+        os.makedirs(target_path, exist_ok=True)
+
+    def place(item):
+        source_file_path, target_file_path = item
+        try:
+            return place_file(source_file_path, target_file_path, link)
+        except OSError as e:
+            print(f"Unable to copy file {source_file_path}. {e.strerror}")
+            return "failed"
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        actions = collections.Counter(executor.map(place, found))
+    actions["missing"] = len(plan) - len(found)
+    print(f"Placed {len(found) - actions['failed']} files in {target_dir} (" +
+          ", ".join(f"{action}: {count}" for action, count in sorted(actions.items())) + ")")
+    return actions
 
 
 def main():
@@ -55,10 +158,17 @@ def main():
     parser.add_argument('--source', required=True, help='Path to the source directory.')
     parser.add_argument('--target', default='data/test-invoices',
                         help='Path to the target directory. Default is "data/test-invoices".')
+    parser.add_argument('--link', choices=['hard', 'reflink', 'symlink'],
+                        help='Link the files instead of copying them: hard links (same filesystem), reflinks '
+                             '(copy-on-write clones) or symbolic links. Falls back to a copy if not supported.')
+    parser.add_argument('--workers', type=int, default=16, help='Number of threads copying files. Default is 16.')
+    parser.add_argument('--dry_run', action='store_true', help='Only plan the copies, nothing is written.')
+    parser.add_argument('--manifest', help='Path to a CSV file listing the planned copies (source, target, action).')
 
     args = parser.parse_args()
 
-    copy_files(csv_file=args.csv, source_dir=args.source, target_dir=args.target)
+    copy_files(csv_file=args.csv, source_dir=args.source, target_dir=args.target, link=args.link,
+               workers=args.workers, dry_run=args.dry_run, manifest=args.manifest)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+import collections
+import contextlib
+import multiprocessing
+import os
+import sys
+import time
+
+import pymupdf
+
+# Reading of the invoice PDF files, kept apart from main.py (and its LLM client imports) so that the parse workers
+# only import PyMuPDF: the spawned workers run this module as their main module instead of main.py
+
+# footer lines: everything after one of them is not part of the invoice
+FOOTER_LINES = [
+    "* May include estimated US sales tax, VAT, ST, GST and CT.",
+]
+
+
+# remove everything after one of the following lines (including the line itself)
+def remove_footer(text):
+    for line in FOOTER_LINES:
+        if line in text:
+            return text.split(line)[0]
+    return text
+
+
+# extract the text of the first max_pages pages (0 for all pages) with PyMuPDF, stopping at the footer
+def read_pdf_text(file_path, max_pages=1):
+    text = ""
+    with pymupdf.open(file_path) as doc:
+        last_page = doc.page_count if max_pages == 0 else min(max_pages, doc.page_count)
+        for page in doc.pages(0, last_page):
+            text += page.get_text()
+            # everything after the footer is removed anyway, so there is no need to read the next pages
+            if any(line in text for line in FOOTER_LINES):
+                break
+    return remove_footer(text)
+
+
+# read an invoice PDF and prepend the file name and DoiT payer id
+def read_invoice(file_path, max_pages=1):
+    invoice = read_pdf_text(file_path, max_pages)
+    # get parent folder name
+    parent_folder = os.path.basename(os.path.dirname(file_path))
+    # extract doit payer id from the parent folder name
+    payer_id = parent_folder.split("_")[1]
+    # add file name to the invoice
+    return f"File name: {os.path.basename(file_path)}\nDoiT payer id: {payer_id}\n" + invoice
+
+
+# read an invoice PDF and return it together with its path and the parse time (seconds)
+def read_document(file_path, max_pages=1):
+    start = time.perf_counter()
+    invoice = read_invoice(file_path, max_pages)
+    return file_path, invoice, time.perf_counter() - start
+
+
+# spawned processes import the main module of the parent first: make this module the main module while the workers
+# are started, so they do not import the script that started them
+@contextlib.contextmanager
+def worker_main():
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = sys.modules[__name__]
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main
+
+
+# apply func (a function of this module) to all items in a process pool, keeping at most `window` items in flight
+# and yielding results in order
+def parallel_map(func, items, workers, window=0):
+    window = window or 4 * workers
+    # spawn instead of fork: the pool can be started from the scan thread of the streaming pipeline; all workers
+    # are started when the pool is created
+    with worker_main():
+        pool = multiprocessing.get_context("spawn").Pool(workers)
+    with pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
@@ -1,6 +1,48 @@
+import asyncio
+import errno
+import json
+import math
+import os
 import pytest
+import threading
 from unittest.mock import patch, MagicMock
-from main import AwsInvoiceCredit, remove_footer, scan_folder, get_sorted_column_values
+from main import (AwsInvoiceCredit, scan_folder, get_sorted_column_values, run_pipeline,
+                  ExtractionCache, RateLimiter, TokenBucket, retry_after, ExtractionChain,
+                  extract_data, token_usage, pre_extract, FastPath, RequestPacker, BatchJob,
+                  ProcessingJournal, repair_output, Telemetry, open_output, save_result, shard_of, shard_output,
+                  merge_shards, check_consistency, ModelCascade, FolderWatcher, RequestHedger,
+                  Preprocessor, prepare_document)
+from read_documents import parallel_map, read_pdf_text, remove_footer
+
+
+INVOICE_DATA = {
+    "file_name": "2024-04-06_Invoice_EUCNGB24_30944.pdf",
+    "doit_payer_id": "doitintl-payer-1998",
+    "document_type": "Credit Note",
+    "ri_invoice": None,
+    "aws_account_number": "206722881646",
+    "address_company": "Texthelp LTD",
+    "address_attn": "Vadim Solovey",
+    "address_country": "United Kingdom",
+    "tax_registration_number": "GB516805252",
+    "billing_period": "March 1, 2024 - March 31, 2024",
+    "invoice_number": "EUCNGB24-30944",
+    "invoice_date": "April 6, 2024",
+    "allocation_number": "154026995",
+    "original_invoice_number": "EUINGB24-1596217",
+    "original_invoice_date": "April 2, 2024",
+    "total_amount": -320.8,
+    "total_amount_currency": "USD",
+    "total_vat_tax_amount": -42.28,
+    "total_vat_tax_currency": "GBP",
+    "net_charges_usd": -267.34,
+    "net_charges_non_usd": None,
+    "net_charges_currency": None,
+    "vat_percentage": 20.0,
+    "exchange_rate": 0.79095,
+    "amazon_company_name": "AMAZON WEB SERVICES EMEA SARL",
+    "amazon_company_branch": "UK BRANCH"
+}
 
 
 def test_aws_invoice_credit_model():
@@ -49,10 +91,10 @@ def test_remove_footer_no_footer():
 
 
 @patch('os.walk')
-@patch('main.PyMuPDFLoader')
-def test_scan_folder(mock_loader, mock_walk):
-    # Mock the return value of PyMuPDFLoader.load method
-    mock_loader.return_value.load.return_value = [MagicMock(page_content='test content')]
+@patch('read_documents.read_pdf_text')
+def test_scan_folder(mock_read_pdf_text, mock_walk):
+    # Mock the return value of read_pdf_text
+    mock_read_pdf_text.return_value = 'test content'
 
     mock_walk.return_value = [
         ('root', 'dirs', ['data/1234_doit-payer-1/file1.pdf', 'data/1234_doit-payer-1/file2.pdf'])
@@ -60,6 +102,56 @@ def test_scan_folder(mock_loader, mock_walk):
     assert len(scan_folder('folder', max_docs=1)) == 1
 
 
+def make_invoice_pdf(path, pages):
+    import pymupdf
+    doc = pymupdf.open()
+    for text in pages:
+        doc.new_page().insert_text((72, 72), text)
+    doc.save(str(path))
+
+
+def test_scan_folder_parse_workers(tmp_path):
+    payer_folder = tmp_path / "1234_doit-payer-1"
+    payer_folder.mkdir()
+    for i in range(6):
+        make_invoice_pdf(payer_folder / f"file{i}.pdf", [f"Invoice {i}"])
+    serial = scan_folder(str(tmp_path))
+    parallel = scan_folder(str(tmp_path), parse_workers=2)
+    assert len(serial) == 6
+    assert serial == parallel
+    assert any(doc.startswith("File name: file0.pdf\nDoiT payer id: doit-payer-1\nInvoice 0") for doc in serial)
+    assert len(scan_folder(str(tmp_path), max_docs=4, parse_workers=2)) == 4
+
+
+def test_parallel_map_workers_skip_main(tmp_path):
+    import subprocess
+    import sys
+    # a script importing main.py starts the workers, they import neither main.py nor the LLM clients
+    script = tmp_path / "script.py"
+    script.write_text("import main\nfrom read_documents import parallel_map\n"
+                      "print(list(parallel_map(eval, ['sorted({\"main\", \"langchain_openai\"} & set(__import__(\"sys\").modules))'] * 2, 2)))\n")
+    result = subprocess.run([sys.executable, str(script)], capture_output=True, text=True, check=True, timeout=60,
+                            env={**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))})
+    assert result.stdout.strip() == "[[], []]"
+    assert list(parallel_map(abs, [-1, 2, -3], 2)) == [1, 2, 3]
+
+
+def test_read_pdf_text_matches_loader(tmp_path):
+    from langchain_community.document_loaders import PyMuPDFLoader
+    path = tmp_path / "invoice.pdf"
+    make_invoice_pdf(path, ["Invoice Number: 123\nTOTAL 1.00", "Usage appendix"])
+    assert read_pdf_text(str(path)) == remove_footer(PyMuPDFLoader(str(path)).load()[0].page_content)
+
+
+def test_read_pdf_text_stops_at_footer(tmp_path):
+    path = tmp_path / "invoice.pdf"
+    footer = "* May include estimated US sales tax, VAT, ST, GST and CT."
+    make_invoice_pdf(path, ["Page one", f"Page two\n{footer}", "Page three"])
+    text = read_pdf_text(str(path), max_pages=0)
+    assert "Page one" in text and "Page two" in text
+    assert "Page three" not in text and footer not in text
+
+
 def test_get_sorted_column_values():
     with patch('builtins.open', new_callable=MagicMock) as mock_open:
         mock_open.return_value.__enter__.return_value.__iter__.return_value = iter(['header', 'value'])
@@ -70,3 +162,783 @@ def test_get_sorted_column_values_file_not_found():
     # New test case
     with pytest.raises(FileNotFoundError):
         get_sorted_column_values('non_existent_file.csv', 0)
+
+
+@pytest.mark.asyncio
+async def test_run_pipeline():
+    documents = [f"File name: file{i}.pdf\nDoiT payer id: doit-payer-1\ncontent" for i in range(5)]
+
+    async def extract(document):
+        file_name = document.split("\n")[0].split(":")[1].strip()
+        if file_name == "file3.pdf":
+            return Exception(f"Error processing document {file_name}")
+        return MagicMock(model_dump=MagicMock(return_value={"file_name": file_name}))
+
+    writer = MagicMock()
+    stats = await run_pipeline(extract, ((None, document) for document in documents), writer, ["file_name"], workers=2)
+    assert stats["documents"] == 5
+    assert stats["records"] == 4
+    assert stats["first_record"] is not None
+    written = sorted(call.args[0]["file_name"] for call in writer.writerow.call_args_list)
+    assert written == ["file0.pdf", "file1.pdf", "file2.pdf", "file4.pdf"]
+
+
+@pytest.mark.asyncio
+async def test_extraction_cache(tmp_path):
+    calls = []
+
+    async def extract():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return AwsInvoiceCredit(**{**INVOICE_DATA, "file_name": "a.pdf", "doit_payer_id": "payer-a"})
+
+    document = "File name: a.pdf\nDoiT payer id: payer-a\ninvoice text"
+    duplicate = "File name: b.pdf\nDoiT payer id: payer-b\ninvoice text"
+    cache = ExtractionCache(str(tmp_path), "fingerprint")
+    first, second = await asyncio.gather(cache.get_or_extract(document, extract),
+                                         cache.get_or_extract(duplicate, extract))
+    assert len(calls) == 1
+    assert (first.file_name, first.doit_payer_id) == ("a.pdf", "payer-a")
+    assert (second.file_name, second.doit_payer_id) == ("b.pdf", "payer-b")
+    assert (cache.misses, cache.duplicates) == (1, 1)
+    cache.close()
+
+    # a new run with the same fingerprint is served from disk, another fingerprint misses
+    cache = ExtractionCache(str(tmp_path), "fingerprint")
+    cached = await cache.get_or_extract(duplicate, extract)
+    assert len(calls) == 1 and cache.hits == 1
+    assert cached.model_dump() == {**INVOICE_DATA, "file_name": "b.pdf", "doit_payer_id": "payer-b"}
+    cache.close()
+    cache = ExtractionCache(str(tmp_path), "other fingerprint")
+    await cache.get_or_extract(document, extract)
+    assert len(calls) == 2 and cache.misses == 1
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_extraction_cache_failed_duplicates(tmp_path):
+    calls = []
+
+    async def extract():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return Exception("Error processing document: invalid JSON") if len(calls) < 3 else \
+            AwsInvoiceCredit(**INVOICE_DATA)
+
+    documents = [f"File name: {name}.pdf\nDoiT payer id: payer\ninvoice text" for name in "abcd"]
+    cache = ExtractionCache(str(tmp_path), "fingerprint")
+    results = await asyncio.gather(*[cache.get_or_extract(document, extract) for document in documents])
+    # each failed attempt is retried by one duplicate at a time, the last one is shared
+    assert [isinstance(result, Exception) for result in results] == [True, True, False, False]
+    assert len(calls) == 3 and cache.duplicates == 1 and not cache.pending
+    cache.close()
+
+
+def test_extraction_cache_eviction(tmp_path):
+    cache = ExtractionCache(str(tmp_path), "fingerprint")
+    for i in range(5):
+        cache.put(cache.key(f"invoice {i}"), {"i": i})
+    cache.evict(max_entries=2)
+    assert cache.db.execute("SELECT COUNT(*) FROM extractions").fetchone()[0] == 2
+    cache.evict(max_age_days=-1)
+    assert cache.db.execute("SELECT COUNT(*) FROM extractions").fetchone()[0] == 0
+    cache.close()
+
+
+class FakeRateLimitError(Exception):
+    def __init__(self, retry_after_header=None):
+        super().__init__("Error code: 429")
+        self.status_code = 429
+        self.response = MagicMock(status_code=429, headers={"retry-after": retry_after_header} if retry_after_header else {})
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_retries_throttled_requests():
+    limiter = RateLimiter(max_concurrency=8, max_retries=3)
+    attempts = []
+
+    async def request():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise FakeRateLimitError("0.01")
+        return "ok"
+
+    assert await limiter.run(request, tokens=100) == "ok"
+    assert len(attempts) == 3
+    assert (limiter.throttled, limiter.retries, limiter.in_flight) == (2, 2, 0)
+    # a burst of throttling errors halves the concurrency limit once
+    assert limiter.limit < 8
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_gives_up_on_permanent_errors():
+    limiter = RateLimiter(max_concurrency=2, max_retries=3)
+
+    async def request():
+        raise ValueError("invalid JSON")
+
+    with pytest.raises(ValueError):
+        await limiter.run(request, tokens=100)
+    assert limiter.retries == 0 and limiter.in_flight == 0
+
+
+def test_rate_limiter_aimd():
+    limiter = RateLimiter(max_concurrency=10)
+    limiter.limit = 4.0
+    limiter.in_flight = 1
+    limiter.release(latency=1.0)
+    assert limiter.limit == 4.25
+    limiter.in_flight = 1
+    limiter.release(throttled=True)
+    assert limiter.limit == 2.125
+
+
+def test_rate_limiter_latency_baseline():
+    import random
+    rng = random.Random(0)
+    # without a budget, normal latency spread never lowers the limit
+    limiter = RateLimiter(max_concurrency=50)
+    for _ in range(1000):
+        limiter.in_flight = 1
+        limiter.last_decrease = 0.0
+        limiter.release(latency=rng.lognormvariate(math.log(0.5), 0.5))
+    assert limiter.limit == 50
+    # with a budget, only latency growing above the recent median does
+    limiter = RateLimiter(max_concurrency=50, tpm=1000000)
+    for _ in range(1000):
+        limiter.in_flight = 1
+        limiter.last_decrease = 0.0
+        limiter.release(latency=rng.lognormvariate(math.log(0.5), 0.5))
+    assert limiter.limit == 50
+    for _ in range(20):
+        limiter.in_flight = 1
+        limiter.last_decrease = 0.0
+        limiter.release(latency=5.0)
+    assert limiter.limit < 50
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate_per_minute=600)
+    now = bucket.updated
+    assert bucket.wait_time(100, now) == 0
+    bucket.take(100)
+    assert bucket.wait_time(100, now) == pytest.approx(10)
+    # requests larger than the bucket only wait until it is full
+    assert bucket.wait_time(10000, now) == pytest.approx(10)
+
+
+def test_retry_after():
+    assert retry_after(FakeRateLimitError("2")) == 2.0
+    assert retry_after(FakeRateLimitError()) is None
+    assert retry_after(ValueError("no response")) is None
+
+
+@pytest.mark.asyncio
+async def test_extraction_chain_shared_prompt():
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    llm = FakeListChatModel(responses=[json.dumps(INVOICE_DATA)] * 2)
+    chain = ExtractionChain(llm)
+    documents = ["File name: a.pdf\nDoiT payer id: payer-a\nbody of invoice A", "File name: b.pdf\nDoiT payer id: payer-b\nbody of invoice B"]
+    prompts = [chain.render(document) for document in documents]
+    # the instructions and the schema are a common prefix, the document is sent once at the end
+    assert prompts[0].startswith(chain.prefix) and prompts[1].startswith(chain.prefix)
+    assert '"invoice_number"' in chain.prefix and "**Important Instructions:**" in chain.prefix
+    assert prompts[0].count("body of invoice A") == 1
+    for document in documents:
+        result = await extract_data(llm, document, asyncio.Semaphore(1), chain=chain)
+        assert result.model_dump() == INVOICE_DATA
+    assert chain.documents == 2
+
+
+@pytest.mark.asyncio
+async def test_telemetry(tmp_path):
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    llm = FakeListChatModel(responses=["not JSON", json.dumps(INVOICE_DATA)])
+    chain = ExtractionChain(llm)
+    telemetry = Telemetry(str(tmp_path / "trace.jsonl"), str(tmp_path / "metrics.prom"))
+    documents = [(f"{name}.pdf", f"File name: {name}.pdf\nDoiT payer id: payer\nbody of invoice {name}") for name in "ab"]
+    for path, _ in documents:
+        telemetry.parsed(path, 0.01)
+
+    async def extract(document):
+        return await extract_data(llm, document, RateLimiter(max_concurrency=1), chain=chain)
+
+    writer = MagicMock()
+    stats = await run_pipeline(extract, iter(documents), writer, ["file_name"], workers=1, telemetry=telemetry)
+    telemetry.close()
+    assert stats["records"] == 1
+    spans = [json.loads(line) for line in (tmp_path / "trace.jsonl").read_text().splitlines()]
+    assert [(span["path"], span["status"], span["requests"]) for span in spans] == [("a.pdf", "failed", 1), ("b.pdf", "done", 1)]
+    assert spans[0]["errors"] == ["OutputParserException"] and spans[0]["error"] == "OutputParserException"
+    assert spans[1]["parse_time"] == 0.01 and spans[1]["llm_latency"] > 0 and spans[1]["errors"] == []
+    metrics = (tmp_path / "metrics.prom").read_text()
+    assert 'invoice_extraction_documents_total{status="failed"} 1' in metrics
+    assert 'invoice_extraction_errors_total{error="OutputParserException"} 1' in metrics
+    assert 'invoice_extraction_seconds_count{stage="llm"} 2' in metrics
+    assert "Errors: OutputParserException: 1" in telemetry.summary()
+
+
+def test_token_usage():
+    from langchain_core.messages import AIMessage
+    message = AIMessage(content="{}", usage_metadata={"input_tokens": 1500, "output_tokens": 300, "total_tokens": 1800},
+                        response_metadata={"token_usage": {"prompt_tokens_details": {"cached_tokens": 1024}}})
+    assert token_usage(message) == (1500, 300, 1024)
+    assert token_usage(AIMessage(content="{}")) == (0, 0, 0)
+
+
+INVOICE_TEXT = """File name: 2024-04-06_Invoice_EUCNGB24_30944.pdf
+DoiT payer id: doitintl-payer-1998
+AMAZON WEB SERVICES EMEA SARL
+Credit Memo
+Account number:
+2067-2288-1646
+Bill to Address:
+Texthelp LTD
+ATTN: Vadim Solovey
+Enkalon Business Centre
+Antrim, BT41 4LS, GB
+Invoice Summary
+Credit Memo Number: EUCNGB24-30944
+Credit Memo Date: April 06, 2024
+Original Invoice Number: EUINGB24-1596217
+Original Invoice Date: April 2, 2024
+Allocation Number: 154026995
+TOTAL AMOUNT USD -320.80
+This document is for the billing period March 1 - March 31 , 2024
+TOTAL VAT
+GBP -42.28
+1 USD = 0.79095 GBP
+"""
+
+
+def test_pre_extract():
+    fields = pre_extract(INVOICE_TEXT)
+    expected = {key: INVOICE_DATA[key] for key in [
+        "file_name", "doit_payer_id", "document_type", "ri_invoice", "aws_account_number", "address_company",
+        "address_attn", "address_country", "billing_period", "invoice_number", "invoice_date", "allocation_number",
+        "original_invoice_number", "original_invoice_date", "total_amount", "total_amount_currency",
+        "total_vat_tax_amount", "total_vat_tax_currency", "exchange_rate", "amazon_company_name"]}
+    assert fields == expected
+
+
+def test_pre_extract_ambiguous_values_are_skipped():
+    fields = pre_extract("File name: a.pdf\nDoiT payer id: p\nInvoice Number: 111111\nInvoice Number: 222222\n"
+                         "Credit Memo\nTOTAL AMOUNT USD 10.00\n")
+    assert "invoice_number" not in fields
+    # a positive total on a credit memo is left to the LLM
+    assert "total_amount" not in fields and "document_type" not in fields
+
+
+def test_preprocessor(capsys):
+    line_items = "\n".join(f"Amazon Elastic Compute Cloud   running   hours {i}\nUSD   {i}.00" for i in range(50))
+    document = (INVOICE_TEXT + "Page 1 of 2\n\nAMAZON WEB SERVICES EMEA SARL\nSummary\n"
+                "Net Charges (After Credits/Discounts, excl. Tax)   USD -267.34\nVAT - 20%\nDetails\n"
+                "Amazon EC2 Reserved Instance (one time fee)   USD 100.00\n" + line_items +
+                "\nTOTAL Tax\nGBP -42.28\nPage 2 of 2\n")
+    preprocessor = Preprocessor()
+    text, raw_tokens, tokens = preprocessor.process(document)
+    # the fields found by the fast path are the same, the kept lines are whitespace-normalised
+    assert pre_extract(text) == pre_extract(document)
+    assert "Net Charges (After Credits/Discounts, excl. Tax) USD -267.34\nVAT - 20%\nDetails\n" \
+           "Amazon EC2 Reserved Instance (one time fee) USD 100.00\n[100 line items omitted]\nTOTAL Tax\nGBP -42.28\n" in text
+    assert "Page" not in text and text.count("AMAZON WEB SERVICES EMEA SARL") == 1
+    assert tokens < raw_tokens / 2 and (preprocessor.removed_lines, preprocessor.collapsed_lines) == (3, 100)
+
+    # rules replaced by a rules file keep the line items
+    text, _, _ = Preprocessor({"line_items_start": None}).process(document)
+    assert "USD 49.00" in text
+
+    # the tokens of each document are reported, also without telemetry
+    assert prepare_document("1_payer/invoice.pdf", document, 0.01, preprocessor) == \
+        preprocessor.process(document)[0]
+    assert f"Preprocessed 1_payer/invoice.pdf: {raw_tokens} -> {tokens} text tokens" in capsys.readouterr().out
+
+
+@pytest.mark.asyncio
+async def test_fast_path():
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    residual = {"tax_registration_number": "GB516805252", "net_charges_usd": -267.34, "vat_percentage": 20.0,
+                "amazon_company_branch": "UK BRANCH", "address_country": "United Kingdom"}
+    llm = FakeListChatModel(responses=[json.dumps(residual), json.dumps(residual), json.dumps(INVOICE_DATA)])
+    chain = ExtractionChain(llm)
+
+    # the country is missing, so only the remaining fields are requested from the LLM
+    fast_path = FastPath("on")
+    document = INVOICE_TEXT.replace("Antrim, BT41 4LS, GB", "Antrim, BT41 4LS, Northern Ireland")
+    result = await extract_data(llm, document, asyncio.Semaphore(1), chain=chain, fast_path=fast_path)
+    assert result.model_dump() == INVOICE_DATA
+    assert fast_path.residual == 1
+    assert '"aws_account_number"' not in next(iter(chain.residual_chains.values())).prefix
+
+    # all required fields are found, the optional ones are still requested from the LLM
+    result = await extract_data(llm, INVOICE_TEXT, asyncio.Semaphore(1), chain=chain, fast_path=fast_path)
+    assert result.model_dump() == INVOICE_DATA and fast_path.residual == 2
+
+    fast_path = FastPath("check")
+    await extract_data(llm, INVOICE_TEXT, asyncio.Semaphore(1), chain=chain, fast_path=fast_path)
+    assert sum(fast_path.mismatches.values()) == 0 and sum(fast_path.checked.values()) == 20
+
+
+def test_check_consistency():
+    assert check_consistency(AwsInvoiceCredit(**INVOICE_DATA)) == []
+    record = AwsInvoiceCredit(**{**INVOICE_DATA, "total_amount": 320.8, "invoice_date": "06/04/2024",
+                                 "address_company": "Amazon Web Services EMEA SARL"})
+    assert check_consistency(record) == ["credit_note_sign", "amounts", "date_format", "address_company"]
+
+
+@pytest.mark.asyncio
+async def test_model_cascade():
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    inconsistent = {**INVOICE_DATA, "total_vat_tax_amount": 42.28}
+    first = FakeListChatModel(responses=[json.dumps(INVOICE_DATA), json.dumps(inconsistent), "not json"])
+    strong = FakeListChatModel(responses=[json.dumps(INVOICE_DATA)])
+    cascade = ModelCascade(ExtractionChain(strong), "small", "large")
+    chain = ExtractionChain(first)
+    results = [await extract_data(first, INVOICE_TEXT, asyncio.Semaphore(1), chain=chain, cascade=cascade)
+               for _ in range(3)]
+    # the consistent result is accepted, the inconsistent and the malformed ones are extracted by the strong model
+    assert all(result.model_dump() == INVOICE_DATA for result in results)
+    assert (cascade.documents["first"], cascade.documents["accepted"], cascade.documents["strong"]) == (3, 1, 2)
+    assert cascade.failed_checks == {"amounts": 1, "OutputParserException": 1}
+    assert cascade.chain.documents == 2
+    assert "first (small) 3 documents" in cascade.summary()
+
+
+@pytest.mark.asyncio
+async def test_request_hedger():
+    from langchain_core.messages import AIMessage
+
+    # model answering after the given delays, one per request
+    class SlowModel:
+        def __init__(self, delays):
+            self.delays = iter(delays)
+
+        async def ainvoke(self, prompt):
+            await asyncio.sleep(next(self.delays))
+            return AIMessage(content=json.dumps(INVOICE_DATA))
+
+    hedger = RequestHedger(ExtractionChain(SlowModel([10, 0.01, 0.3])), share=0.5, budget=0.5, min_samples=3)
+    hedger.latencies.extend([0.01, 0.01, 0.01])
+    limiter = RateLimiter(max_concurrency=4)
+    # the straggler is hedged, the hedge wins and the straggler is cancelled
+    start = asyncio.get_running_loop().time()
+    result = await hedger.ainvoke(INVOICE_TEXT, limiter)
+    assert result.model_dump() == INVOICE_DATA and asyncio.get_running_loop().time() - start < 1
+    await asyncio.sleep(0)
+    assert (hedger.hedged, hedger.hedge_wins, limiter.in_flight) == (1, 1, 0)
+    # the budget (half of the requests) is spent, the next straggler is not hedged
+    await hedger.ainvoke(INVOICE_TEXT, limiter)
+    assert (hedger.requests, hedger.hedged, hedger.over_budget) == (2, 1, 1)
+    assert "Hedged requests: 1/2" in hedger.summary()
+
+
+@pytest.mark.asyncio
+async def test_request_packer():
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    records = [{**INVOICE_DATA, "file_name": f"file{i}.pdf", "doit_payer_id": "payer"} for i in range(3)]
+    # the packed response misses the last document, which is sent again on its own
+    llm = FakeListChatModel(responses=[json.dumps({"invoices": records[:2]}), json.dumps(records[2])])
+    packer = RequestPacker(ExtractionChain(llm), docs_per_request=3)
+    documents = [f"File name: file{i}.pdf\nDoiT payer id: payer\nbody {i}" for i in range(3)]
+    results = await asyncio.gather(*[extract_data(llm, document, asyncio.Semaphore(1), chain=packer)
+                                     for document in documents])
+    assert [result.file_name for result in results] == ["file0.pdf", "file1.pdf", "file2.pdf"]
+    assert (packer.requests, packer.fallbacks) == (1, 1)
+    assert packer.batch_chain.documents == 3 and packer.chain.documents == 1
+
+
+@pytest.mark.asyncio
+async def test_request_packer_malformed_response():
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    llm = FakeListChatModel(responses=["not JSON", json.dumps(INVOICE_DATA), json.dumps(INVOICE_DATA)])
+    packer = RequestPacker(ExtractionChain(llm), docs_per_request=4, max_wait=0.01)
+    documents = [f"File name: file{i}.pdf\nDoiT payer id: payer\nbody {i}" for i in range(2)]
+    # an incomplete request is sent after max_wait, the malformed response falls back to single documents
+    results = await asyncio.gather(*[extract_data(llm, document, asyncio.Semaphore(1), chain=packer)
+                                     for document in documents])
+    assert all(result.model_dump() == INVOICE_DATA for result in results)
+    assert (packer.requests, packer.fallbacks) == (1, 2)
+
+
+# in-memory stand-in for the files and batches endpoints of the OpenAI API
+class FakeBatchClient:
+    def __init__(self):
+        self.files = MagicMock()
+        self.batches = MagicMock()
+        self.contents = {}
+        self.requests = []
+        self.status = "in_progress"
+        self.files.create = self.create_file
+        self.files.content = self.file_content
+        self.batches.create = self.create_batch
+        self.batches.retrieve = self.retrieve_batch
+
+    async def create_file(self, file, purpose):
+        self.requests = [json.loads(line) for line in file.read().decode().splitlines()]
+        return MagicMock(id="file-in")
+
+    async def create_batch(self, input_file_id, endpoint, completion_window):
+        return MagicMock(id="batch-1", status="validating")
+
+    async def retrieve_batch(self, batch_id):
+        if self.status != "completed":
+            return MagicMock(status=self.status, output_file_id=None, error_file_id=None, request_counts=None)
+        lines = []
+        for request in self.requests:
+            payer_id = request["custom_id"].split("/")[0].split("_")[1]
+            file_name = request["custom_id"].split("/")[1]
+            content = json.dumps({**INVOICE_DATA, "file_name": file_name, "doit_payer_id": payer_id})
+            lines.append(json.dumps({"custom_id": request["custom_id"], "response": {"status_code": 200, "body": {
+                "choices": [{"message": {"content": content}}], "usage": {"prompt_tokens": 10, "completion_tokens": 5}}}}))
+        self.contents["file-out"] = MagicMock(text="\n".join(lines))
+        return MagicMock(status="completed", output_file_id="file-out", error_file_id=None, request_counts=None)
+
+    async def file_content(self, file_id):
+        return self.contents[file_id]
+
+
+@pytest.mark.asyncio
+async def test_batch_job(tmp_path):
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    client = FakeBatchClient()
+    output = str(tmp_path / "invoices.csv")
+    documents = [(f"data/123_payer/file{i}.pdf", f"File name: file{i}.pdf\nDoiT payer id: payer\nbody {i}")
+                 for i in range(3)]
+    job = BatchJob(client, ExtractionChain(FakeListChatModel(responses=[])), output, "gpt-4o", {}, root="data")
+    await job.submit(iter(documents))
+    assert [request["custom_id"] for request in client.requests] == [
+        "123_payer/file0.pdf", "123_payer/file1.pdf", "123_payer/file2.pdf"]
+    assert client.requests[0]["body"]["messages"][0]["content"].endswith("body 0\n<document>\n\nJSON:\n")
+
+    # the state survives a restart: submitting again skips documents of pending batches
+    job = BatchJob(client, ExtractionChain(FakeListChatModel(responses=[])), output, "gpt-4o", {}, root="data")
+    await job.submit(iter(documents))
+    assert len(job.state["batches"]) == 1
+    assert not await job.status()
+
+    client.status = "completed"
+    writer = MagicMock()
+    assert await job.status()
+    assert await job.collect(writer, ["file_name"]) == 3
+    assert job.state["batches"][0]["collected"] and job.chain.prompt_tokens == 30
+    assert sorted(call.args[0]["file_name"] for call in writer.writerow.call_args_list) == [
+        "file0.pdf", "file1.pdf", "file2.pdf"]
+
+
+def test_processing_journal(tmp_path):
+    data = tmp_path / "data"
+    (data / "1_payer-a").mkdir(parents=True)
+    (data / "2_payer-b").mkdir(parents=True)
+    # same file name in two payer folders
+    done, failed = data / "1_payer-a" / "invoice.pdf", data / "2_payer-b" / "invoice.pdf"
+    done.write_bytes(b"pdf a")
+    failed.write_bytes(b"pdf b")
+    journal_file = str(tmp_path / "invoices.csv.journal")
+    journal = ProcessingJournal(journal_file, str(data))
+    journal.record(str(done), "done")
+    journal.record(str(failed), "failed", "Error processing document invoice.pdf")
+    journal.close()
+    # a crash in the middle of a write leaves a torn last line
+    with open(journal_file, "a") as f:
+        f.write('{"path": "2_payer-b/inv')
+
+    journal = ProcessingJournal(journal_file, str(data), retry_failed="1_*")
+    assert journal.skip(str(done)) and journal.skip(str(failed))
+    assert journal.entries["2_payer-b/invoice.pdf"]["attempts"] == 1
+    assert ProcessingJournal(journal_file, str(data)).skip(str(failed)) is False
+    # a changed document is processed again
+    done.write_bytes(b"pdf a, reissued")
+    assert not journal.skip(str(done))
+    journal.close()
+    with open(journal_file) as f:
+        assert len(f.read().splitlines()) == 2
+
+
+def test_processing_journal_import_output(tmp_path):
+    data = tmp_path / "data"
+    for folder in ("1_payer-a", "2_payer-b"):
+        (data / folder).mkdir(parents=True)
+    old, first, second = data / "1_payer-a" / "old.pdf", data / "1_payer-a" / "invoice.pdf", data / "2_payer-b" / "invoice.pdf"
+    for path in (old, first):
+        path.write_bytes(path.name.encode())
+    # output of a run without a journal
+    output = tmp_path / "invoices.csv"
+    output.write_text("file_name,doit_payer_id\nold.pdf,payer-a\n")
+    journal_file = f"{output}.journal"
+
+    journal = ProcessingJournal(journal_file, str(data))
+    journal.import_output(str(output))
+    assert journal.skip(str(old)) and not journal.skip(str(first))
+    journal.record(str(first), "done")
+    journal.close()
+    # the same file name in another payer folder is not taken for a processed document
+    second.write_bytes(b"other invoice")
+    journal = ProcessingJournal(journal_file, str(data))
+    assert journal.skip(str(old)) and journal.skip(str(first)) and not journal.skip(str(second))
+    # a document deleted before its result is recorded is processed again if it comes back
+    second.unlink()
+    journal.record(str(second), "done")
+    second.write_bytes(b"other invoice")
+    assert not journal.skip(str(second))
+    journal.close()
+
+
+def test_compare_columns():
+    pd = pytest.importorskip("pandas")
+    from compare_results import compare_columns, compare_values
+    pairs = [(None, 0), (0.0, float("nan")), (None, None), (" Credit Note", "credit note"), ("Invoice", "Credit Note"),
+             (320.80001, 320.8), (320.8, 320.9), (456, 456), (456, 457), (True, True), (True, None), ("1", 1)]
+    test, experiment = (pd.Series(values, dtype=object) for values in zip(*pairs))
+    assert compare_columns(test, experiment).tolist() == [compare_values(*pair) for pair in pairs]
+
+
+def test_compare_csv_files(tmp_path):
+    pd = pytest.importorskip("pandas")
+    from compare_results import compare_csv_files
+    test = pd.DataFrame({"file_name": ["a.pdf", "b.pdf", "c.pdf"], "document_type": ["Invoice", "Credit Note", "Invoice"],
+                         "aws_account_number": [456, 789, 123], "total_amount": [10.0, -5.0, 7.5]})
+    experiments = {
+        # c.pdf is missing, d.pdf is extra, b.pdf is extracted as an invoice
+        "invoices-small.csv": pd.DataFrame({"file_name": ["a.pdf", "b.pdf", "d.pdf"],
+                                            "document_type": ["invoice ", "Invoice", "Invoice"],
+                                            "aws_account_number": [456, 789, 111], "total_amount": [10.00001, 5.0, 1.0]}),
+        "invoices-large.csv": test.assign(total_amount=[10.0, -5.0, 8.5]),
+    }
+    test.to_csv(tmp_path / "invoices-test.csv", index=False)
+    for name, frame in experiments.items():
+        frame.to_csv(tmp_path / name, index=False)
+    output = tmp_path / "differences.csv"
+
+    reports = compare_csv_files(str(tmp_path / "invoices-test.csv"), [str(tmp_path / name) for name in experiments],
+                                str(output))
+    small, large = (reports[str(tmp_path / name)] for name in experiments)
+    assert (small["similar_rows"], small["different_rows"], small["missing"], small["extra"]) == (1, 1, ["c.pdf"], ["d.pdf"])
+    assert small["accuracy"]["differences"].to_dict() == {"document_type": 1, "aws_account_number": 0, "total_amount": 1}
+    assert small["confusion"].loc["credit note", "invoice"] == 1 and small["confusion"].loc["invoice", "invoice"] == 1
+    assert (large["similar_rows"], large["different_rows"], large["missing"], large["extra"]) == (2, 1, [], [])
+    # test row followed by the experiment row of each difference, integers written as integers
+    with open(output) as f:
+        assert f.read().splitlines() == [
+            "model_name,file_name,document_type,aws_account_number,total_amount",
+            "test,b.pdf,Credit Note,789,-5.0",
+            "small,b.pdf,Invoice,789,5.0",
+            "test,c.pdf,Invoice,123,7.5",
+            "large,c.pdf,Invoice,123,8.5",
+        ]
+
+
+def test_parquet_output(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    output = str(tmp_path / "invoices.parquet")
+    journal = ProcessingJournal(str(tmp_path / "journal"), str(tmp_path))
+    paths = []
+    for i in range(3):
+        paths.append(tmp_path / f"file{i}.pdf")
+        paths[-1].write_bytes(b"%PDF")
+    header = list(AwsInvoiceCredit.model_fields)
+    with open_output(output, header, "parquet", row_group_size=2) as writer:
+        for i, path in enumerate(paths):
+            save_result(writer, header, str(path), AwsInvoiceCredit(**{**INVOICE_DATA, "file_name": f"file{i}.pdf"}),
+                        journal)
+        # the buffered record is recorded in the journal only once it is written
+        assert len(journal.entries) == 2
+    assert len(journal.entries) == 3
+    # a resumed run appends a new file to the dataset
+    with open_output(output, header, "parquet") as writer:
+        writer.writerow({**INVOICE_DATA, "file_name": "file3.pdf"})
+    table = pq.read_table(output)
+    assert table.num_rows == 4 and len(list((tmp_path / "invoices.parquet").iterdir())) == 3
+    assert str(table.schema.field("total_amount").type) == "double" and not table.schema.field("total_amount").nullable
+    assert str(table.schema.field("ri_invoice").type) == "bool" and table.schema.field("ri_invoice").nullable
+    assert table.to_pylist()[0] == {**INVOICE_DATA, "file_name": "file0.pdf"}
+
+
+def test_shards_and_merge(tmp_path):
+    data = tmp_path / "data" / "1234_doit-payer-1"
+    data.mkdir(parents=True)
+    documents = [f"1234_doit-payer-1/file{i}.pdf" for i in range(8)]
+    for document in documents:
+        (tmp_path / "data" / document).write_bytes(document.encode())
+    # the shard of a document depends only on its relative path
+    assert [shard_of(document, 2) for document in documents] == [shard_of(document, 2) for document in documents]
+    assert {shard_of(document, 2) for document in documents} == {1, 2}
+    assert shard_output("out/invoices.csv", 2, 4) == "out/invoices.shard-2-of-4.csv"
+
+    output = str(tmp_path / "invoices.csv")
+    header = ["file_name", "doit_payer_id", "total_amount"]
+    shard_documents = {shard: [d for d in documents if shard_of(d, 2) == shard] for shard in (1, 2)}
+    for shard, shard_docs in shard_documents.items():
+        path = shard_output(output, shard, 2)
+        journal = ProcessingJournal(f"{path}.journal", str(tmp_path / "data"))
+        with open_output(path, header) as writer:
+            # the last document of shard 2 is not processed, the first document of shard 1 is written twice
+            for document in shard_docs[:-1] if shard == 2 else shard_docs + shard_docs[:1]:
+                record = AwsInvoiceCredit(**{**INVOICE_DATA, "file_name": document.split("/")[1]})
+                save_result(writer, header, str(tmp_path / "data" / document), record, journal)
+        journal.close()
+    stats = merge_shards(output, str(tmp_path / "data"))
+    assert stats == {"records": 7, "duplicates": 1, "incomplete": [2]}
+    with open(output) as f:
+        assert f.readline().strip().split(",") == list(AwsInvoiceCredit.model_fields)
+
+
+def test_copy_files(tmp_path):
+    from prepare_data import copy_files
+    source = tmp_path / "source"
+    for folder, name in [("1111_payer-a", "a.pdf"), ("9999_payer-b", "b.pdf")]:
+        (source / folder).mkdir(parents=True)
+        (source / folder / name).write_bytes(b"%PDF")
+    csv_file = tmp_path / "invoices-test.csv"
+    # b.pdf is found in the only folder of payer-b, c.pdf does not exist
+    csv_file.write_text("file_name,doit_payer_id,document_type,aws_account_number\n"
+                        "a.pdf,payer-a,Invoice,1111\nb.pdf,payer-b,Invoice,2222\nc.pdf,payer-c,Invoice,3333\n")
+    target = tmp_path / "target"
+    manifest = tmp_path / "manifest.csv"
+    assert copy_files(str(csv_file), str(source), str(target), link="hard", dry_run=True, manifest=str(manifest))["missing"] == 1
+    assert not target.exists()
+    assert [row.split(",")[2] for row in manifest.read_text().splitlines()] == ["action", "hard", "hard", "missing"]
+    actions = copy_files(str(csv_file), str(source), str(target), link="hard")
+    assert actions == {"hard": 2, "missing": 1}
+    assert (target / "2222_payer-b" / "b.pdf").stat().st_ino == (source / "9999_payer-b" / "b.pdf").stat().st_ino
+
+    # symbolic links, copies where they are not supported
+    assert copy_files(str(csv_file), str(source), str(tmp_path / "links"), link="symlink")["symlink"] == 2
+    assert (tmp_path / "links" / "1111_payer-a" / "a.pdf").is_symlink()
+    with patch("os.symlink", side_effect=PermissionError(errno.EPERM, "Operation not permitted")):
+        assert copy_files(str(csv_file), str(source), str(tmp_path / "copies"), link="symlink")["copy"] == 2
+    assert not (tmp_path / "copies" / "1111_payer-a" / "a.pdf").is_symlink()
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_folder_watcher(tmp_path, use_inotify):
+    (tmp_path / "1_payer").mkdir()
+    (tmp_path / "1_payer" / "old.pdf").write_bytes(b"%PDF")
+    watcher = FolderWatcher(str(tmp_path), poll_interval=0.05, use_inotify=use_inotify)
+    assert watcher.start() == [str(tmp_path / "1_payer" / "old.pdf")]
+
+    # a new file in a watched folder, a replaced file and a new folder with a file, other files are ignored
+    (tmp_path / "1_payer" / "new.pdf").write_bytes(b"%PDF")
+    (tmp_path / "1_payer" / "notes.txt").write_text("")
+    (tmp_path / "1_payer" / "old.pdf.tmp").write_bytes(b"%PDF-1.7")
+    os.replace(tmp_path / "1_payer" / "old.pdf.tmp", tmp_path / "1_payer" / "old.pdf")
+    (tmp_path / "2_payer").mkdir()
+    (tmp_path / "2_payer" / "other.pdf").write_bytes(b"%PDF")
+    stop = threading.Event()
+    timer = threading.Timer(10, stop.set)
+    timer.start()
+    found = set()
+    for path in watcher.watch(stop):
+        found.add(path)
+        if len(found) == 3:
+            stop.set()
+    timer.cancel()
+    watcher.close()
+    assert found == {str(tmp_path / "1_payer" / name) for name in ("new.pdf", "old.pdf")} | {
+        str(tmp_path / "2_payer" / "other.pdf")}
+
+
+def test_watch_documents_stop(tmp_path):
+    from main import watch_documents
+    (tmp_path / "1_payer").mkdir()
+    for i in range(5):
+        make_invoice_pdf(tmp_path / "1_payer" / f"file{i}.pdf", [f"Invoice {i}"])
+    stop = threading.Event()
+    documents = []
+    for path, document in watch_documents(FolderWatcher(str(tmp_path), use_inotify=False), stop):
+        documents.append(path)
+        # SIGTERM while the documents already in the folder are extracted
+        stop.set()
+    assert len(documents) == 1
+
+
+def test_repair_output(tmp_path):
+    output = tmp_path / "invoices.csv"
+    output.write_text("file_name,doit_payer_id\na.pdf,payer\nb.pdf,pa")
+    repair_output(str(output))
+    assert output.read_text() == "file_name,doit_payer_id\na.pdf,payer\n"
+    repair_output(str(output))
+    assert output.read_text() == "file_name,doit_payer_id\na.pdf,payer\n"
+
+
+@pytest.mark.asyncio
+async def test_benchmark_stub_round_trip(tmp_path, monkeypatch):
+    import csv
+    from benchmark import generate_corpus, start_stub
+    from main import create_llm, iter_documents
+    monkeypatch.setenv("OPENAI_API_KEY", "benchmark")
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    truth = generate_corpus(str(tmp_path / "data"), documents=4, payers=2, credit_note_rate=0.5)
+    expected = {row["file_name"]: row for row in csv.DictReader(open(truth))}
+    server = start_stub(latency="fixed:0.01")
+    try:
+        llm = create_llm("openai", "stub", {}, max_retries=0, base_url=server.base_url)
+        chain = ExtractionChain(llm)
+        for path, document in iter_documents(str(tmp_path / "data"), max_pages=0):
+            result = await extract_data(llm, document, RateLimiter(max_concurrency=1), chain=chain)
+            row = expected[result.file_name]
+            assert (result.document_type, result.invoice_number) == (row["document_type"], row["invoice_number"])
+            assert result.total_amount == float(row["total_amount"])
+        assert server.requests == 4 and chain.prompt_tokens > 0
+    finally:
+        server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_benchmark_stub_batch(tmp_path, monkeypatch, capsys):
+    import csv
+    import sys
+    import main
+    from benchmark import generate_corpus, start_stub
+    monkeypatch.setenv("OPENAI_API_KEY", "benchmark")
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    truth = generate_corpus(str(tmp_path / "data"), documents=4, payers=2, credit_note_rate=0.5)
+    expected = {row["file_name"]: row for row in csv.DictReader(open(truth))}
+    output = tmp_path / "invoices.csv"
+    server = start_stub(batch_seconds=60, throttle_rate=0.3, seed=1)
+
+    async def run(action):
+        monkeypatch.setattr(sys, "argv", ["main.py", f"--data_dir={tmp_path / 'data'}", f"--output={output}",
+                                          f"--base_url={server.base_url}", "--mode=batch", f"--batch_action={action}",
+                                          "--max_pages=0"])
+        await main.main()
+        return capsys.readouterr().out
+
+    try:
+        assert "with 4 documents" in await run("submit")
+        assert ": in_progress" in await run("status")
+        server.batch_seconds = 0
+        collected = await run("collect")
+    finally:
+        server.shutdown()
+    assert ": completed (3/4 completed, 1 failed)" in collected and "Added 3 records" in collected
+    rows = list(csv.DictReader(open(output)))
+    assert len(rows) == 3
+    for row in rows:
+        assert row["invoice_number"] == expected[row["file_name"]]["invoice_number"]
+    assert "Journal: 3 documents done, 1 failed" in collected
+
+
+@pytest.mark.asyncio
+async def test_benchmark_stub_bedrock(tmp_path, monkeypatch):
+    pytest.importorskip("boto3")
+    from concurrent.futures import ThreadPoolExecutor
+    from benchmark import BEDROCK_MODEL, generate_corpus, start_stub
+    from main import create_llm, iter_documents
+    for name, value in {"AWS_ACCESS_KEY_ID": "benchmark", "AWS_SECRET_ACCESS_KEY": "benchmark",
+                        "AWS_DEFAULT_REGION": "us-east-1", "NO_PROXY": "127.0.0.1"}.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv("AWS_PROFILE", raising=False)
+    generate_corpus(str(tmp_path / "data"), documents=8, payers=2)
+    server = start_stub(latency="fixed:0.2")
+    try:
+        # the blocking Bedrock requests run in the default executor, sized like the connection pool
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=8))
+        llm = create_llm("bedrock", BEDROCK_MODEL, {}, max_retries=0, base_url=server.endpoint_url, pool_size=8)
+        chain = ExtractionChain(llm)
+        results = await asyncio.gather(*[extract_data(llm, document, RateLimiter(max_concurrency=8), chain=chain)
+                                         for _, document in iter_documents(str(tmp_path / "data"), max_pages=0)])
+        assert all(isinstance(result, AwsInvoiceCredit) for result in results)
+        assert server.requests == 8 and server.peak_in_flight == 8
+    finally:
+        server.shutdown()
+